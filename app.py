@@ -1,18 +1,36 @@
+from __future__ import annotations
+
 import math
 import os
-import io
+import re
+import shutil
+import subprocess
+import tempfile
 import time
 import datetime
+import hashlib
+import itertools
 import json
-import openai
 import logging
 import asyncio
-import boto3
-from pydub import AudioSegment
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 from chalice import Chalice
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
+from chalicelib import metrics
+from chalicelib.cache import TTLCache, MISSING
+from chalicelib.openai_client import (call_with_failover, call_with_retries, iterate_with_timeout, reset_deadline,
+                                      set_deadline, OPENAI_HEDGE_AFTER_SECONDS)
+from chalicelib.tokens import count_text_tokens, count_message_tokens, count_prompt_tokens
+from chalicelib.storage import get_storage, get_month_bucket, get_spending_timestamp, SPENDING_ALL_TIME_BUCKET
+from chalicelib.update_queue import UPDATE_QUEUE, LambdaUpdateQueue, LocalUpdateQueue, get_worker_function_name
+
+# openai, boto3 and telegram are imported on first use, see get_openai, chalicelib.storage and the handlers,
+# so importing the module stays cheap (checked by bench/import_time.py)
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import CallbackContext
 
 # Enable logging
 logging.basicConfig(
@@ -23,50 +41,160 @@ logger = logging.getLogger(__name__)
 TELEGRAM_API_TOKEN = os.getenv("TELEGRAM_API_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_ID = os.getenv("BOT_ADMIN_USER_ID")
-DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE_NAME")
-DYNAMODB_USER_TABLE = os.getenv("DYNAMODB_USERS_TABLE_NAME")
-DYNAMODB_CONFIG_TABLE = os.getenv("DYNAMODB_CONFIG_TABLE_NAME")
-DYNAMODB_SPENDINGS_TABLE = os.getenv("DYNAMODB_SPENDINGS_TABLE_NAME")
 
 APP_NAME = "gpt-telegram-bot"
 LAMBDA_MESSAGE_HANDLER = "lambda-message-handler"
+LAMBDA_UPDATE_WORKER = "lambda-update-worker"
 ADMIN_USER_KEY = "admin_user"
 TYPE_ITEM_MESSAGE = "message"
 TYPE_ITEM_USER = "allowed_user"
+BOOTSTRAP_CONFIG_KEY = "__bootstrap__"
+BOOTSTRAP_VERSION = 1  # Bump when the admin seed data below changes
 CONTEXTS_FOLDER = "chalicelib"
 NUMBER_OF_PREDEFINED_CONTEXT_MESSAGES = 1  # TODO: Will be dynamic
 PERMISSION_ERROR_TEXT = "You don't have permissions to use that bot!"
+TOO_LONG_TEXT = "Your message is too long for {}: {} tokens, at most {} fit"
+OVER_BUDGET_TEXT = "This request could cost up to {} USD, over your monthly budget of {} USD ({} USD spent)"
+RATE_LIMITED_TEXT = "Too many requests, please try again in {} seconds"
 
 CALLBACK_CORRECT_TRANSCRIPT = "correct_transcript"
 CALLBACK_WRONG_TRANSCRIPT = "wrong_transcript"
-VOICE_PROCESSING_KEYBOARD = [[InlineKeyboardButton(text="Correct! Send it to GPT!", callback_data=CALLBACK_CORRECT_TRANSCRIPT)],
-                             [InlineKeyboardButton(text="No, I'll copy and edit myself", callback_data=CALLBACK_WRONG_TRANSCRIPT)]]
-
-MODELS = {"gpt3": {"model": "gpt-3.5-turbo", "request_price": 2, "response_price": 2},
-          "gpt4": {"model": "gpt-4", "response_price": 60, "request_price": 20}}
-IMAGE_MODELS = {"dall-e": {"model": "dall-e", "response_price": 20}}
+VOICE_PROCESSING_KEYBOARD = [[("Correct! Send it to GPT!", CALLBACK_CORRECT_TRANSCRIPT)],
+                             [("No, I'll copy and edit myself", CALLBACK_WRONG_TRANSCRIPT)]]
+
+MODELS = {"gpt3": {"model": "gpt-3.5-turbo", "request_price": 2, "response_price": 2, "context_window": 4096},
+          "gpt4": {"model": "gpt-4", "response_price": 60, "request_price": 20, "context_window": 8192}}
+IMAGE_MODELS = {"dall-e": {"model": "dall-e", "response_price": 20,
+                            "prices_by_size": {"256x256": 16, "512x512": 18, "1024x1024": 20}}}
+DEFAULT_IMAGE_SIZE = "1024x1024"
+# Telegram albums hold up to 10 photos, DALL-E answers up to 10 images per request
+IMAGE_MAX_COUNT = 4
 VOICE_MODELS = {"whisper": {"model": "whisper-1", "price_per_minute": 6}}
 DEFAULT_WHISPER_MODEL = "whisper-1"
-
-
-# Initialize the OpenAI library
-openai.api_key = OPENAI_API_KEY
+# Containers Whisper accepts as they are, by the mime type Telegram reports for the audio
+WHISPER_UPLOAD_FILENAMES = {"audio/ogg": "voice.ogg", "audio/mpeg": "voice.mp3", "audio/mp4": "voice.m4a",
+                            "audio/wav": "voice.wav", "audio/x-wav": "voice.wav", "audio/webm": "voice.webm",
+                            "audio/flac": "voice.flac"}
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+# Voice notes longer than that are split on silences and the chunks are transcribed concurrently
+LONG_VOICE_SECONDS = int(os.getenv("LONG_VOICE_SECONDS", "120"))
+VOICE_CHUNK_SECONDS = 60  # Preferred chunk length, a cut is placed in the silence closest to it
+VOICE_CHUNK_MAX_SECONDS = 90
+VOICE_CHUNK_MIN_SECONDS = 20
+VOICE_SILENCE_FILTER = "silencedetect=noise=-30dB:d=0.4"
+WHISPER_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+TRANSCRIBE_CONCURRENCY = 4
+# ffmpeg processes running at once, they are CPU bound and a long-running process serves many users at a time
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", str(os.cpu_count() or 1)))
+# Part of the model context window kept free for the completion itself, and the longest completion requested
+REPLY_RESERVED_TOKENS = 1024
+CONTEXT_PAGE_SIZE = 20
+# Conversation messages expire that many days after being sent, 0 keeps them until /clear
+MESSAGE_TTL_DAYS = int(os.getenv("MESSAGE_TTL_DAYS", "0"))
+# Checked before every GPT request against this month's spendings plus the request's worst case price, 0 disables
+USER_MONTHLY_BUDGET_USD = float(os.getenv("USER_MONTHLY_BUDGET_USD", "0"))
+# Once a prompt passes COMPACTION_THRESHOLD_TOKENS (0 disables), the history older than the last
+# COMPACTION_KEEP_TOKENS is replaced by a summary message, written by COMPACTION_MODEL
+COMPACTION_THRESHOLD_TOKENS = int(os.getenv("COMPACTION_THRESHOLD_TOKENS", "3000"))
+COMPACTION_KEEP_TOKENS = 1000
+COMPACTION_MAX_INPUT_TOKENS = 2500
+COMPACTION_SUMMARY_TOKENS = 400
+COMPACTION_MODEL = "gpt3"
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+SUMMARY_INSTRUCTIONS = ("Summarize the conversation below for your own future reference. Keep the facts, names, "
+                        "decisions, open questions and preferences of the user, drop the small talk. "
+                        "Write at most a few short paragraphs.")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "60"))
+CACHE_MAX_SIZE = 1024
+USERS_PAGE_SIZE = 50
+# Opt-in cache of GPT answers by model and normalized prompt, in the storage backend with a per-container hot tier.
+# Identical questions get the same answer for RESPONSE_CACHE_TTL_SECONDS.
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+RESPONSE_CACHE_HOT_SIZE = 256
+# Transcripts by Telegram file_unique_id, which stays the same when a voice note is forwarded or sent again
+TRANSCRIPT_CACHE_TTL_SECONDS = int(os.getenv("TRANSCRIPT_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+TRANSCRIPT_CACHE_KEY_PREFIX = "transcript:"
+# Telegram file ids of the photos generated for a prompt and size, sending them again costs nothing
+IMAGE_CACHE_TTL_SECONDS = int(os.getenv("IMAGE_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+IMAGE_CACHE_KEY_PREFIX = "image:"
+STREAMING_REPLIES = os.getenv("STREAMING_REPLIES", "true").lower() == "true"
+# Telegram allows about one message update per second in a chat, edits are throttled below that
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv("STREAM_EDIT_INTERVAL_SECONDS", "1.5"))
+STREAM_PLACEHOLDER_TEXT = "..."
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_CONNECTION_POOL_SIZE = 8
+OPENAI_CONNECTION_POOL_SIZE = 8
+# Seconds an OpenAI request may take by model, streamed completions get it for the first and every next chunk
+OPENAI_TIMEOUT_SECONDS = {"gpt-3.5-turbo": 30, "gpt-4": 60, "dall-e": 60, "whisper-1": 60}
+OPENAI_DEFAULT_TIMEOUT_SECONDS = 60
+# The OpenAI requests of a Lambda invocation end that many seconds before its timeout (lambda_timeout in
+# .chalice/config.json), the rest is kept for sending the reply and writing the spending
+LAMBDA_DEADLINE_MARGIN_SECONDS = float(os.getenv("LAMBDA_DEADLINE_MARGIN_SECONDS", "10"))
+# Model answering instead when the one of the user keeps failing, if the prompt fits its window
+FALLBACK_MODELS = {"gpt4": "gpt3"}
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "8"))
+# Telegram re-delivers an update until the webhook answers, processed update ids are remembered that long
+PROCESSED_UPDATE_TTL_SECONDS = 24 * 60 * 60
+# The messages of a user are answered one turn at a time, the ones arriving meanwhile get one answer together.
+# The turn holder renews it every TURN_RENEW_SECONDS, a turn left behind by a crashed invocation expires soon
+TURN_TTL_SECONDS = 30
+TURN_RENEW_SECONDS = 10
+# Token buckets, 0 disables a limit. The model limits are shared by all users, like the OpenAI ones, so every
+# completion of every user reads and writes the same item: they are opt-in
+USER_REQUESTS_PER_MINUTE = int(os.getenv("USER_REQUESTS_PER_MINUTE", "20"))
+USER_REQUESTS_BURST = int(os.getenv("USER_REQUESTS_BURST", "5"))
+MODEL_REQUESTS_PER_MINUTE = {"gpt-3.5-turbo": int(os.getenv("GPT3_REQUESTS_PER_MINUTE", "0")),
+                             "gpt-4": int(os.getenv("GPT4_REQUESTS_PER_MINUTE", "0"))}
+MODEL_BURST_SECONDS = 10
+
+
+# All OpenAI calls are async and share one aiohttp session, created on the first call inside the warm
+# event loop, so warm containers keep their keep-alive connections
+openai_aiohttp_session = None
+# Blocking storage calls run in this bounded pool instead of on the event loop
+io_executor = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix="io")
+ffmpeg_slots = asyncio.Semaphore(FFMPEG_CONCURRENCY)
 # Initialize the Chalice app
 app = Chalice(app_name=APP_NAME)
-# Connect to DynamoDB
-dynamodb = boto3.resource("dynamodb")
-messages_table = dynamodb.Table(DYNAMODB_TABLE)
-users_table = dynamodb.Table(DYNAMODB_USER_TABLE)
-config_table = dynamodb.Table(DYNAMODB_CONFIG_TABLE)
-spendings_table = dynamodb.Table(DYNAMODB_SPENDINGS_TABLE)
+# Per-container caches in front of the allow-list and config reads, every write below invalidates them.
+# Other containers may serve a stale entry for at most CACHE_TTL_SECONDS.
+users_cache = TTLCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL_SECONDS)
+config_cache = TTLCache(maxsize=CACHE_MAX_SIZE, ttl=CACHE_TTL_SECONDS)
+roster_cache = TTLCache(maxsize=4, ttl=CACHE_TTL_SECONDS)
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_HOT_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS)
+transcript_cache = TTLCache(maxsize=RESPONSE_CACHE_HOT_SIZE, ttl=TRANSCRIPT_CACHE_TTL_SECONDS)
+image_cache = TTLCache(maxsize=RESPONSE_CACHE_HOT_SIZE, ttl=IMAGE_CACHE_TTL_SECONDS)
 
 
 ################# OTHER FUNCTIONS #############################
-def get_price(tokens, user_id):
-    model = get_config(user_id)
+async def run_io(func, *args, **kwargs):
+    """Run a blocking (storage or CPU bound) call in io_executor without blocking the event loop.
+
+    Context variables of the calling task are visible to the call, like with asyncio.to_thread.
+    """
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(io_executor, call)
+
+
+def get_price(tokens, user_id, model=None):
+    """Price of the tokens with the prices of model, by default the model of the user."""
+    if model is None:
+        model = get_config(user_id)
     return tokens["completion_tokens"] * model["response_price"] / 1000 / 1000 + tokens["prompt_tokens"] * model["request_price"] / 1000 / 1000
 
 
+def get_model_by_name(model_name):
+    """The MODELS entry of model_name, None for names it doesn't list (e.g. stored by older versions)."""
+    return next((model for model in MODELS.values() if model["model"] == model_name), None)
+
+
+def get_context_budget(model_name):
+    # Unknown models are given the smallest window, the one of gpt-3.5
+    model = get_model_by_name(model_name) or MODELS["gpt3"]
+    return model["context_window"] - REPLY_RESERVED_TOKENS
+
+
 # Context
 def load_contexts(user_id):
     filenames = get_json_filenames(CONTEXTS_FOLDER)
@@ -88,15 +216,16 @@ def json_from_file(name):
         return json.load(f)
 
 
-################# DYNAMO DB DATA PROCESSING #############################
+################# STORAGE DATA PROCESSING #############################
 # Users
+@metrics.timed("auth")
 def allowed_only(user_id, user_role):
-    response = users_table.get_item(
-        Key={"user_id": str(user_id),
-             "user_type": str(user_role)
-             }
-    )
-    return "Item" in response
+    cache_key = (str(user_id), str(user_role))
+    allowed = users_cache.get(cache_key)
+    if allowed is MISSING:
+        allowed = get_storage().has_user(user_id, user_role)
+        users_cache.set(cache_key, allowed)
+    return allowed
 
 
 def admin_user(user_id):
@@ -108,74 +237,88 @@ def allowed_user(user_id):
 
 
 def _add_allowed_user(user_id, user_role):
-    users_table.put_item(
-        Item={
-            "user_id": str(user_id),
-            "user_type": str(user_role)
-        }
-    )
+    get_storage().add_user(user_id, user_role)
+    users_cache.invalidate((str(user_id), str(user_role)))
+    roster_cache.invalidate(str(user_role))
     if user_role == TYPE_ITEM_USER:
         load_contexts(user_id)
 
 
+def _delete_allowed_user(user_id, user_role):
+    get_storage().delete_user(user_id, user_role)
+    users_cache.invalidate((str(user_id), str(user_role)))
+    roster_cache.invalidate(str(user_role))
+
+
 # Messages
+def get_message_expiry(message_id):
+    # The predefined context messages never expire
+    if not MESSAGE_TTL_DAYS or int(message_id) <= NUMBER_OF_PREDEFINED_CONTEXT_MESSAGES:
+        return None
+    return int(time.time()) + MESSAGE_TTL_DAYS * 24 * 60 * 60
+
+
 def store_message(user_id, message_id, role, text, tokens_used={}):
-    messages_table.put_item(
-        Item={
-            "user_id": str(user_id),
-            "message_id": int(message_id),
-            "role": role,
-            "text": text,
-            "tokens_used": tokens_used
-        }
-    )
+    # The token count is cached on the message, so prompts are sized without tokenizing the history again
+    get_storage().put_message(user_id, message_id, role, text, tokens_used, count_text_tokens(text),
+                              get_message_expiry(message_id))
 
 
-def delete_messages(user_id):
-    messages = get_messages(user_id)
-    with messages_table.batch_writer() as batch:
-        for msg in messages:
-            if int(msg["message_id"]) > NUMBER_OF_PREDEFINED_CONTEXT_MESSAGES:
-                batch.delete_item(
-                    Key={
-                        "user_id": str(user_id),
-                        "message_id": int(msg["message_id"])
-                    }
-                )
+def clear_history(user_id, up_to_id):
+    """Hide the history up to up_to_id from now on with one conditional write, see reap_cleared_messages."""
+    get_storage().clear_history(user_id, up_to_id)
+    config_cache.invalidate(str(user_id))
+
+
+def reap_cleared_messages(user_id, up_to_id):
+    get_storage().delete_messages(user_id, NUMBER_OF_PREDEFINED_CONTEXT_MESSAGES, up_to_id)
+
+
+def get_history_start(user_id):
+    """Id of the first message of the history, past the predefined messages and the last /clear."""
+    config = get_config(user_id) or {}
+    return max(NUMBER_OF_PREDEFINED_CONTEXT_MESSAGES, int(config.get("cleared_up_to", 0))) + 1
 
 
 def get_messages(user_id):
-    response = messages_table.query(
-        KeyConditionExpression=boto3.dynamodb.conditions.Key(
-            "user_id").eq(str(user_id))
+    return list(get_storage().query_messages(user_id))
+
+
+def get_predefined_messages(user_id):
+    return list(get_storage().query_messages(
+        user_id, last_id=NUMBER_OF_PREDEFINED_CONTEXT_MESSAGES, fields=["role", "text", "tokens"]))
+
+
+def get_history_newest_first(user_id, before_message_id):
+    first_id = get_history_start(user_id)
+    if int(before_message_id) - 1 < first_id:
+        return iter(())
+    # Pages are fetched lazily, the caller stops iterating once its token budget is used up
+    return get_storage().query_messages(
+        user_id,
+        first_id=first_id,
+        last_id=int(before_message_id) - 1,
+        newest_first=True,
+        page_size=CONTEXT_PAGE_SIZE,
+        fields=["message_id", "role", "text", "tokens"]
     )
-    return response["Items"]
 
 
 def get_message_by_id(user_id, message_id):
-    response = messages_table.get_item(
-        Key={
-            "user_id": str(user_id),
-            "message_id": int(message_id)
-        }
-    )
-    if "Item" in response:
-        item = response["Item"]
+    item = get_storage().get_message(user_id, message_id)
+    if item:
         return item["text"]
     else:
-        raise Exception("Item is not found in DynamoDB")
+        raise Exception("Item is not found in storage")
 
 
 # Config
 def get_config(user_id):
-    response = config_table.get_item(
-        Key={
-            "user_id": str(user_id)
-        }
-    )
-    if "Item" in response:
-        return response["Item"]
-    return None
+    config = config_cache.get(str(user_id))
+    if config is MISSING:
+        config = get_storage().get_config(user_id)
+        config_cache.set(str(user_id), config)
+    return config
 
 
 def is_config_present(user_id):
@@ -186,103 +329,261 @@ def is_config_present(user_id):
 
 
 def create_initial_config(user_id, model):
-    config_table.put_item(
-        Item={
-            "user_id": str(user_id),
-            "model": model["model"],
-            "request_price": model["request_price"],
-            "response_price": model["response_price"]
-        }
-    )
+    get_storage().put_config(user_id, {
+        "model": model["model"],
+        "request_price": model["request_price"],
+        "response_price": model["response_price"]
+    })
+    config_cache.invalidate(str(user_id))
+
+
+# Response cache
+def normalize_prompt_text(text):
+    # Case, spacing and trailing punctuation don't change the question
+    return re.sub(r"\s+", " ", text).strip().rstrip("?!. ").lower()
+
+
+def get_response_cache_key(model_name, chat_context, user_text):
+    """Hash of the model and of the normalized messages the model would see."""
+    messages = [(msg["role"], normalize_prompt_text(msg["content"])) for msg in chat_context]
+    messages.append(("user", normalize_prompt_text(user_text)))
+    return hashlib.sha256(json.dumps([model_name, messages]).encode()).hexdigest()
+
+
+@metrics.timed("response_cache")
+def get_cached_response(key):
+    response = response_cache.get(key)
+    if response is MISSING:
+        response = get_storage().get_cached_response(key)
+        if response is not None:
+            response_cache.set(key, response)
+    return response
+
+
+def cache_response(key, response):
+    response_cache.set(key, response)
+    get_storage().put_cached_response(key, response, RESPONSE_CACHE_TTL_SECONDS)
+
+
+# Transcripts share the response cache storage under their own key prefix
+@metrics.timed("transcript_cache")
+def get_cached_transcript(file_unique_id):
+    transcript = transcript_cache.get(file_unique_id)
+    if transcript is MISSING:
+        transcript = get_storage().get_cached_response(TRANSCRIPT_CACHE_KEY_PREFIX + file_unique_id)
+        if transcript is not None:
+            transcript_cache.set(file_unique_id, transcript)
+    return transcript
+
+
+def cache_transcript(file_unique_id, text, duration):
+    transcript = {"text": text, "duration": duration}
+    transcript_cache.set(file_unique_id, transcript)
+    get_storage().put_cached_response(TRANSCRIPT_CACHE_KEY_PREFIX + file_unique_id, transcript,
+                                      TRANSCRIPT_CACHE_TTL_SECONDS)
+
+
+def get_image_cache_key(prompt, size):
+    return hashlib.sha256(json.dumps([normalize_prompt_text(prompt), size]).encode()).hexdigest()
+
+
+@metrics.timed("image_cache")
+def get_cached_images(key):
+    """Return the Telegram file ids of the photos cached under key, an empty list when there are none.
+
+    Misses aren't kept in image_cache, photos another container generates later are found in the storage."""
+    file_ids = image_cache.get(key)
+    if file_ids is MISSING:
+        cached = get_storage().get_cached_response(IMAGE_CACHE_KEY_PREFIX + key)
+        if cached is None:
+            return []
+        file_ids = cached["file_ids"]
+        image_cache.set(key, file_ids)
+    return file_ids
+
+
+def cache_images(key, file_ids):
+    image_cache.set(key, file_ids)
+    get_storage().put_cached_response(IMAGE_CACHE_KEY_PREFIX + key, {"file_ids": file_ids}, IMAGE_CACHE_TTL_SECONDS)
+
+
+# Turns and rate limits
+@metrics.timed("turn")
+def acquire_turn(user_id, owner):
+    return get_storage().acquire_turn(user_id, owner, TURN_TTL_SECONDS)
+
+
+def renew_turn(user_id, owner):
+    return get_storage().renew_turn(user_id, owner, TURN_TTL_SECONDS)
+
+
+def release_turn(user_id, owner, answered_up_to):
+    get_storage().release_turn(user_id, owner, answered_up_to)
+
+
+async def keep_turn(user_id, owner):
+    """Renew the turn until cancelled, so a long answer (retries, failover, compaction) isn't taken over."""
+    while True:
+        await asyncio.sleep(TURN_RENEW_SECONDS)
+        if not await run_io(renew_turn, user_id, owner):
+            logger.warning("Turn of user %s was taken over while answering", user_id)
+            return
+
+
+def get_pending_messages(user_id, answered_up_to):
+    """User messages after answered_up_to, the assistant replies in between are skipped.
+
+    Read consistently: a message stored by an invocation that found the turn taken must be seen here."""
+    messages = get_storage().query_messages(
+        user_id, first_id=int(answered_up_to) + 1, fields=["message_id", "role", "text"], consistent=True)
+    return [msg for msg in messages if msg["role"] == "user"]
+
+
+@metrics.timed("rate_limit")
+def take_request_tokens(user_id):
+    """Return 0 when a completion for the user fits the user and model rate limits, otherwise the seconds to wait."""
+    config = get_config(user_id) or {}
+    limits = [("user:" + str(user_id), USER_REQUESTS_BURST, USER_REQUESTS_PER_MINUTE)]
+    model_requests_per_minute = MODEL_REQUESTS_PER_MINUTE.get(config.get("model"), 0)
+    limits.append(("model:" + str(config.get("model")),
+                   max(1, model_requests_per_minute * MODEL_BURST_SECONDS // 60), model_requests_per_minute))
+    for key, capacity, requests_per_minute in limits:
+        if requests_per_minute:
+            wait = get_storage().take_token(key, capacity, requests_per_minute / 60)
+            if wait:
+                return wait
+    return 0
+
+
+# Updates
+@metrics.timed("dedupe")
+def claim_update(update_id):
+    return get_storage().claim_update(update_id, PROCESSED_UPDATE_TTL_SECONDS)
+
+
+# The seed marker is kept per admin, so a new BOT_ADMIN_USER_ID is seeded without bumping BOOTSTRAP_VERSION
+def get_bootstrap_key():
+    return BOOTSTRAP_CONFIG_KEY + str(ADMIN_ID)
+
+
+def get_bootstrap_version():
+    item = get_config(get_bootstrap_key())
+    if item:
+        return int(item["seed_version"])
+    return 0
+
+
+def store_bootstrap_version(version):
+    # Never downgrades the version a concurrent container may have stored
+    get_storage().put_seed_version(get_bootstrap_key(), version)
+    config_cache.invalidate(get_bootstrap_key())
 
 
 def update_config(user_id, model):
-    config_table.update_item(
-        Key={
-            "user_id": str(user_id)
-        },
-        UpdateExpression="set model=:m, request_price=:r, response_price=:rp",
-        ExpressionAttributeValues={
-            ":m": model["model"],
-            ":r": model["request_price"],
-            ":rp": model["response_price"]
-        },
-        ReturnValues="UPDATED_NEW"
-    )
+    get_storage().update_config(user_id, {
+        "model": model["model"],
+        "request_price": model["request_price"],
+        "response_price": model["response_price"]
+    })
+    config_cache.invalidate(str(user_id))
 
 
 def delete_config(user_id):
-    config_table.delete_item(
-        Key={
-            "user_id": str(user_id)
-        }
-    )
+    get_storage().delete_config(user_id)
+    config_cache.invalidate(str(user_id))
 
 
 # Spendings
-def add_spending(user_id, tokens_spent, model_name):
-    timestamp = int(time.time())
-    spendings_table.put_item(
-        Item={
-            "user_id": str(user_id),
-            "timestamp": timestamp,
-            "completion_tokens": int(tokens_spent["completion_tokens"]),
-            "prompt_tokens": int(tokens_spent["prompt_tokens"]),
-            "price_in_10th_of_cents": math.ceil(get_price(tokens_spent, user_id) * 1000),
-            "model_name": model_name,
-            "human_readable_time": datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-        }
-    )
-
-
+def get_spending_item(user_id, tokens_spent, model_name, model=None):
+    timestamp = get_spending_timestamp()
+    return {
+        "user_id": str(user_id),
+        "timestamp": timestamp,
+        "completion_tokens": int(tokens_spent["completion_tokens"]),
+        "prompt_tokens": int(tokens_spent["prompt_tokens"]),
+        "price_in_10th_of_cents": math.ceil(get_price(tokens_spent, user_id, model) * 1000),
+        "model_name": model_name,
+        "human_readable_time": datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+@metrics.timed("spending_write")
+def add_spending(user_id, tokens_spent, model_name, model=None):
+    spending = get_spending_item(user_id, tokens_spent, model_name, model)
+    timestamp = get_storage().put_spending(spending)
+    get_storage().add_to_spending_totals(user_id, spending["price_in_10th_of_cents"], get_month_bucket(timestamp))
+
+
+@metrics.timed("spending_write")
 def add_image_voice_spending(user_id, price, model_name):
-    timestamp = int(time.time())
-    spendings_table.put_item(
-        Item={
-            "user_id": str(user_id),
-            "timestamp": timestamp,
-            "price_in_10th_of_cents": price,
-            "model_name": model_name,
-            "human_readable_time": datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
-        }
-    )
+    timestamp = get_spending_timestamp()
+    timestamp = get_storage().put_spending({
+        "user_id": str(user_id),
+        "timestamp": timestamp,
+        "price_in_10th_of_cents": price,
+        "model_name": model_name,
+        "human_readable_time": datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    })
+    get_storage().add_to_spending_totals(user_id, price, get_month_bucket(timestamp))
 
 
 def get_spendings_for_user(user_id):
-    sum = 0
-    spending_items = spendings_table.query(
-        KeyConditionExpression=boto3.dynamodb.conditions.Key(
-            "user_id").eq(str(user_id))
-    )["Items"]
-    for item in spending_items:
-        sum += item["price_in_10th_of_cents"]
-    return sum / 1000
+    """Return the all-time and the current month spendings of the user in USD."""
+    totals = get_storage().get_spending_totals(user_id)
+    current_month = get_month_bucket(int(time.time()))
+    return totals.get(SPENDING_ALL_TIME_BUCKET, 0) / 1000, totals.get(current_month, 0) / 1000
 
 
 def get_all_spendings():
-    spending_items = spendings_table.scan()["Items"]
-    spendings_by_user = {}
-    for item in spending_items:
-        user_id = item['user_id']
-        spendings = item['price_in_10th_of_cents']
+    return get_storage().get_all_spending_totals()
 
-        if user_id not in spendings_by_user:
-            spendings_by_user[user_id] = 0
 
-        spendings_by_user[user_id] += spendings
-    return spendings_by_user
+def rebuild_spending_totals():
+    return get_storage().rebuild_spending_totals()
 
 
 ######################## CHAT GPT MESSAGES PROCESSING ################################
-# Function to get a response from ChatGPT
-def get_chatgpt_response(prompt, chat_context, model_name="gpt-3.5-turbo"):
+def get_openai():
+    """Return the openai module set up with the API key and the shared aiohttp session."""
+    global openai_aiohttp_session
+    import aiohttp
+    import openai
+    openai.api_key = OPENAI_API_KEY
+    if openai_aiohttp_session is None or openai_aiohttp_session.closed:
+        openai_aiohttp_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=OPENAI_CONNECTION_POOL_SIZE))
+    openai.aiosession.set(openai_aiohttp_session)
+    return openai
+
+
+def get_fallback_model_name(model_name, chat_context):
+    """Name of the model to fail over to, None when there's none or the prompt doesn't fit it."""
+    key = next((key for key, model in MODELS.items() if model["model"] == model_name), None)
+    fallback = MODELS.get(FALLBACK_MODELS.get(key))
+    if fallback is None or count_prompt_tokens(chat_context) + REPLY_RESERVED_TOKENS > fallback["context_window"]:
+        return None
+    return fallback["model"]
+
+
+async def create_chat_completion(chat_context, model_name, hedge_after=0, **params):
+    """ChatCompletion.acreate with retries and failover, returns (response, name of the model that answered)."""
+    fallback_model = get_fallback_model_name(model_name, chat_context)
+    return await call_with_failover(
+        lambda name: get_openai().ChatCompletion.acreate(model=name, messages=chat_context, **params),
+        model_name, OPENAI_TIMEOUT_SECONDS.get(model_name, OPENAI_DEFAULT_TIMEOUT_SECONDS),
+        fallback_model=fallback_model, fallback_timeout=OPENAI_TIMEOUT_SECONDS.get(fallback_model),
+        hedge_after=hedge_after)
+
+
+# Function to get a response from ChatGPT, returns the text, the tokens and the model that answered
+@metrics.timed("openai")
+async def get_chatgpt_response(prompt, chat_context, model_name="gpt-3.5-turbo"):
     print("User asked: " + prompt)
     print("Actual model used: " + model_name)
     chat_context.append({"role": "user", "content": prompt})
-    response = openai.ChatCompletion.create(
-        model=model_name,
-        messages=chat_context
-    )
+    # The answer is capped at the tokens reserved for it, which the budget check counts as the worst case
+    response, model_name = await create_chat_completion(chat_context, model_name, OPENAI_HEDGE_AFTER_SECONDS,
+                                                        max_tokens=REPLY_RESERVED_TOKENS)
     print("Model from OpenAI response: " + response.model)
     response_text = response.choices[0].message.content.strip()
     prompt_tokens = response.usage.prompt_tokens
@@ -290,51 +591,459 @@ def get_chatgpt_response(prompt, chat_context, model_name="gpt-3.5-turbo"):
     total_tokens = response.usage.total_tokens
     print("Total tokens: " + str(total_tokens) + " Prompt tokens: " +
           str(prompt_tokens) + " Completion tokens: " + str(completion_tokens))
-    return response_text, {"total_tokens": total_tokens, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+    metrics.increment("prompt_tokens", prompt_tokens)
+    metrics.increment("completion_tokens", completion_tokens)
+    return response_text, {"total_tokens": total_tokens, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}, model_name
 
 
-def process_text(user_text, user_id, message_id):
-    chat_context = get_formatted_messages_for_gpt(user_id)
-    model_name = get_config(user_id)["model"]
+# Streams the completion, calling on_update with the text received so far.
+# Only opening the stream is retried or failed over, a stream can't be retried once text was shown
+@metrics.timed("openai")
+async def get_chatgpt_response_stream(prompt, chat_context, model_name, on_update):
+    print("User asked: " + prompt)
+    print("Actual model used: " + model_name)
+    chat_context.append({"role": "user", "content": prompt})
+    stream, model_name = await create_chat_completion(
+        chat_context, model_name,
+        stream=True,
+        max_tokens=REPLY_RESERVED_TOKENS,
+        # The last chunk then carries the exact usage of the whole request
+        stream_options={"include_usage": True}
+    )
+    response_text = ""
+    usage = None
+    started_at = time.perf_counter()
+    async for chunk in iterate_with_timeout(stream, OPENAI_TIMEOUT_SECONDS.get(model_name, OPENAI_DEFAULT_TIMEOUT_SECONDS)):
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+        if chunk["choices"]:
+            delta = chunk["choices"][0]["delta"].get("content")
+            if delta:
+                if not response_text:
+                    metrics.add_phase("openai_first_token", (time.perf_counter() - started_at) * 1000)
+                response_text += delta
+                await on_update(response_text)
+    response_text = response_text.strip()
+    if usage:
+        prompt_tokens = usage["prompt_tokens"]
+        completion_tokens = usage["completion_tokens"]
+    else:
+        logger.warning("No usage in the streamed response, falling back to estimated tokens")
+        prompt_tokens = count_prompt_tokens(chat_context)
+        completion_tokens = count_text_tokens(response_text)
+    total_tokens = prompt_tokens + completion_tokens
+    print("Total tokens: " + str(total_tokens) + " Prompt tokens: " +
+          str(prompt_tokens) + " Completion tokens: " + str(completion_tokens))
+    metrics.increment("prompt_tokens", prompt_tokens)
+    metrics.increment("completion_tokens", completion_tokens)
+    return response_text, {"total_tokens": total_tokens, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}, model_name
+
+
+@metrics.timed("context")
+def get_chat_for_user(user_id, message_id, user_text):
+    """Return the model name, the chat context preceding message_id and the tokens of the whole prompt,
+    user_text included. (None, [], 0) for users without config."""
+    config = get_config(user_id)
+    if config is None:
+        return None, [], 0
+    model_name = config["model"]
     print("Model will be used: " + model_name)
-    response, tokens = get_chatgpt_response(
-        user_text, chat_context, model_name)
-    add_spending(user_id, tokens, model_name)
-    store_message(user_id, int(message_id) + 1, "assistant", response, tokens)
-    # if "image:" in response:
-    #     prompt = response.split(":")[1].split("\"")[0]
-    #     response = prompt + "\n" + get_generated_image(prompt)
+    # The user message and the reply priming are always part of the prompt, the history gets what is left
+    reserved_tokens = count_message_tokens(user_text) + count_prompt_tokens([])
+    context, context_tokens = get_formatted_messages_for_gpt(user_id, model_name, message_id, reserved_tokens)
+    return model_name, context, context_tokens + reserved_tokens
+
+
+def get_month_spending(user_id):
+    return get_spendings_for_user(user_id)[1] if USER_MONTHLY_BUDGET_USD else 0
+
+
+# The reply is stored under the id of its Telegram message, which no later message of the chat can take
+def get_message_item(message_id, role, text, tokens_used={}):
+    return {"message_id": message_id, "role": role, "text": text, "tokens_used": tokens_used,
+            "tokens": count_text_tokens(text), "expires_at": get_message_expiry(message_id)}
+
+
+@metrics.timed("spending_write")
+def store_reply(user_id, reply_message_id, response, tokens, model_name):
+    """Store the reply with its spending in one write, so history and billing can't disagree."""
+    get_storage().put_exchange(user_id, [get_message_item(reply_message_id, "assistant", response, tokens)],
+                               get_spending_item(user_id, tokens, model_name, get_model_by_name(model_name)))
+
+
+async def process_text(bot, chat_id, user_text, user_id, message_id):
+    """Answer user_text in the chat, then store the reply and its spending while the cost is sent.
+
+    The prompt size and worst case price are computed locally first, a prompt over the model window or
+    over the monthly budget of the user is refused without calling OpenAI.
+    Returns (None, None) when the request is refused."""
+    chat, wait, month_spending = await asyncio.gather(
+        run_io(get_chat_for_user, user_id, message_id, user_text),
+        run_io(take_request_tokens, user_id),
+        run_io(get_month_spending, user_id)
+    )
+    if wait:
+        await bot.send_message(chat_id=chat_id, text=RATE_LIMITED_TEXT.format(math.ceil(wait)))
+        return None, None
+    model_name, chat_context, prompt_tokens = chat
+    budget = get_context_budget(model_name)
+    if prompt_tokens > budget:
+        await bot.send_message(chat_id=chat_id, text=TOO_LONG_TEXT.format(model_name, prompt_tokens, budget))
+        return None, None
+    if USER_MONTHLY_BUDGET_USD:
+        worst_case_price = await run_io(get_price, {"prompt_tokens": prompt_tokens,
+                                                    "completion_tokens": REPLY_RESERVED_TOKENS}, user_id)
+        if month_spending + worst_case_price > USER_MONTHLY_BUDGET_USD:
+            await bot.send_message(chat_id=chat_id, text=OVER_BUDGET_TEXT.format(
+                round(worst_case_price, 4), USER_MONTHLY_BUDGET_USD, round(month_spending, 4)))
+            return None, None
+    cache_key = get_response_cache_key(model_name, chat_context, user_text) if RESPONSE_CACHE else None
+    cached = await run_io(get_cached_response, cache_key) if cache_key else None
+    background = []
+    if cached is not None:
+        # Nothing is spent on a cache hit, the zero spending is still recorded with the reply
+        metrics.increment("response_cache_hits")
+        response = cached["text"]
+        tokens = {"total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        reply_message_id = (await send_markdown(bot, chat_id, response)).message_id
+        cost_text = "Answered from cache, it costed 0 USD"
+    else:
+        if cache_key:
+            metrics.increment("response_cache_misses")
+        requested_model_name = model_name
+        if STREAMING_REPLIES:
+            reply = StreamingReply(bot, chat_id)
+            await reply.start()
+            reply_message_id = reply.message.message_id
+            response, tokens, model_name = await get_chatgpt_response_stream(
+                user_text, chat_context, model_name, reply.update)
+            await reply.finish(response)
+        else:
+            response, tokens, model_name = await get_chatgpt_response(
+                user_text, chat_context, model_name)
+            reply_message_id = (await send_markdown(bot, chat_id, response)).message_id
+        # if "image:" in response:
+        #     prompt = response.split(":")[1].split("\"")[0]
+        #     response = prompt + "\n" + get_generated_image(prompt)
+        # Billed at the prices of the model that answered, which differs from the user's after a failover.
+        # Models missing from MODELS are billed at the prices in the config of the user
+        price = await run_io(get_price, tokens, user_id, get_model_by_name(model_name))
+        print("Price: " + str(price))
+        cost_text = "Last request used " + str(tokens["total_tokens"]) + " tokens. It costed " + str(price) + " USD"
+        if model_name != requested_model_name:
+            cost_text = model_name + " answered, " + requested_model_name + " is unavailable. " + cost_text
+        if cache_key and response:
+            background.append(run_io(cache_response, cache_key, {"text": response, "model": model_name}))
+        if COMPACTION_THRESHOLD_TOKENS and tokens["prompt_tokens"] > COMPACTION_THRESHOLD_TOKENS:
+            background.append(compact_history(user_id, message_id))
+    await asyncio.gather(
+        run_io(store_reply, user_id, reply_message_id, response, tokens, model_name),
+        bot.send_message(chat_id=chat_id, text=cost_text),
+        *background
+    )
     return response, tokens
 
 
-def get_formatted_messages_for_gpt(user_id):
-    return [{"role": msg["role"], "content": msg["text"]} for msg in get_messages(user_id)]
+@metrics.timed("telegram_reply")
+async def send_markdown(bot, chat_id, text):
+    from telegram.constants import ParseMode
+    from telegram.error import BadRequest
+    try:
+        return await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
+    except BadRequest:
+        # GPT answers are not always valid Telegram markdown
+        return await bot.send_message(chat_id=chat_id, text=text)
+
+
+class StreamingReply:
+    """Telegram message edited in place while a completion streams in.
+
+    Edits are throttled to STREAM_EDIT_INTERVAL_SECONDS and back off on RetryAfter. Text that
+    outgrows one Telegram message continues in a new message.
+    """
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message = None
+        self.offset = 0  # Start of the current message within the full text
+        self.shown_text = ""
+        self.next_edit_at = 0
+
+    @metrics.timed("telegram_reply")
+    async def start(self):
+        self.message = await self.bot.send_message(chat_id=self.chat_id, text=STREAM_PLACEHOLDER_TEXT)
+
+    async def update(self, text):
+        if time.monotonic() >= self.next_edit_at:
+            await self._show(text, final=False)
+
+    @metrics.timed("telegram_reply")
+    async def finish(self, text):
+        await self._show(text or STREAM_PLACEHOLDER_TEXT, final=True)
+
+    async def _show(self, text, final):
+        while len(text) - self.offset > TELEGRAM_MESSAGE_LIMIT:
+            await self._edit(text[self.offset:self.offset + TELEGRAM_MESSAGE_LIMIT], final=True)
+            self.offset += TELEGRAM_MESSAGE_LIMIT
+            self.shown_text = ""
+            self.message = await self.bot.send_message(chat_id=self.chat_id, text=STREAM_PLACEHOLDER_TEXT)
+        await self._edit(text[self.offset:], final)
+
+    async def _edit(self, text, final):
+        from telegram.constants import ParseMode
+        from telegram.error import BadRequest, RetryAfter
+        if text == self.shown_text and not final:
+            return
+        self.next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL_SECONDS
+        try:
+            # Partial markdown is usually malformed, so only the final text is sent as markdown
+            await self.message.edit_text(text, parse_mode=ParseMode.MARKDOWN if final else None)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            if final:
+                await asyncio.sleep(retry_after)
+                await self._edit(text, final)
+                return
+            self.next_edit_at = time.monotonic() + retry_after
+            return
+        except BadRequest as e:
+            if "not modified" in str(e):
+                pass
+            elif final:
+                await self.message.edit_text(text)
+            else:
+                raise
+        self.shown_text = text
+
+
+def get_formatted_messages_for_gpt(user_id, model_name, before_message_id, reserved_tokens=0):
+    """Build the chat context: the predefined messages followed by as much history before
+    before_message_id as fits the model budget minus reserved_tokens. Returns the messages and their tokens."""
+    budget = get_context_budget(model_name) - reserved_tokens
+    predefined = get_predefined_messages(user_id)
+    used_tokens = sum(count_message_tokens(msg["text"], msg.get("tokens")) for msg in predefined)
+    history = []
+    for msg in get_history_newest_first(user_id, before_message_id):
+        tokens = count_message_tokens(msg["text"], msg.get("tokens"))
+        if used_tokens + tokens > budget:
+            break
+        used_tokens += tokens
+        history.append(msg)
+    history.reverse()
+    return [{"role": msg["role"], "content": msg["text"]} for msg in predefined + history], used_tokens
+
+
+# History compaction
+@metrics.timed("compaction")
+async def compact_history(user_id, before_message_id):
+    """Replace the history before before_message_id, except its last COMPACTION_KEEP_TOKENS, by one summary message.
+
+    Runs after the answer is sent. The previous summary is always the oldest message summarized, so it rolls over.
+    Failures are only logged, the history then stays as it is until the next try.
+    """
+    try:
+        previous_summary, messages = await run_io(get_messages_to_compact, user_id, before_message_id)
+        if len(messages) < 2:
+            return
+        summary, tokens = await summarize_messages(([previous_summary] if previous_summary else []) + messages)
+        await run_io(store_compaction, user_id, previous_summary, messages, summary, tokens)
+        print("Compacted " + str(len(messages)) + " messages of the history into a summary")
+    except Exception as e:
+        logger.exception("History compaction failed: " + str(e))
+
+
+def is_summary(msg):
+    return msg["role"] == "system" and msg["text"].startswith(SUMMARY_PREFIX)
+
+
+def get_messages_to_compact(user_id, before_message_id):
+    """Return (previous summary, messages): the newest COMPACTION_MAX_INPUT_TOKENS of history past the kept
+    recent part, oldest first, and the newest summary older than them, None when it is among them or missing.
+
+    The messages between that summary and the others are left out of the new summary and kept as they are."""
+    kept_tokens = 0
+    input_tokens = 0
+    messages = []
+    history = get_history_newest_first(user_id, before_message_id)
+    for msg in history:
+        tokens = count_message_tokens(msg["text"], msg.get("tokens"))
+        if kept_tokens + tokens <= COMPACTION_KEEP_TOKENS and not messages:
+            if is_summary(msg):
+                # Compacted recently, there's nothing newer to summarize yet
+                return None, []
+            kept_tokens += tokens
+            continue
+        input_tokens += tokens
+        if input_tokens > COMPACTION_MAX_INPUT_TOKENS:
+            previous_summary = next((older for older in itertools.chain([msg], history) if is_summary(older)), None)
+            messages.reverse()
+            return previous_summary, messages
+        messages.append(msg)
+        if is_summary(msg):
+            break
+    messages.reverse()
+    return None, messages
+
+
+async def summarize_messages(messages):
+    transcript = "\n".join(msg["role"] + ": " + msg["text"] for msg in messages)
+    response, _ = await create_chat_completion(
+        [{"role": "system", "content": SUMMARY_INSTRUCTIONS}, {"role": "user", "content": transcript}],
+        MODELS[COMPACTION_MODEL]["model"],
+        max_tokens=COMPACTION_SUMMARY_TOKENS
+    )
+    usage = response.usage
+    return response.choices[0].message.content.strip(), {"total_tokens": usage.total_tokens,
+                                                        "prompt_tokens": usage.prompt_tokens,
+                                                        "completion_tokens": usage.completion_tokens}
+
+
+def store_compaction(user_id, previous_summary, messages, summary, tokens):
+    """The summary takes the place of the newest summarized message, the other summarized ones are deleted.
+
+    Only those: history older than messages that the summary doesn't cover stays."""
+    last_message_id = int(messages[-1]["message_id"])
+    get_storage().put_exchange(
+        user_id, [get_message_item(last_message_id, "system", SUMMARY_PREFIX + summary, tokens)],
+        get_spending_item(user_id, tokens, MODELS[COMPACTION_MODEL]["model"], MODELS[COMPACTION_MODEL]))
+    get_storage().delete_messages(user_id, int(messages[0]["message_id"]) - 1, last_message_id - 1)
+    if previous_summary is not None:
+        previous_summary_id = int(previous_summary["message_id"])
+        get_storage().delete_messages(user_id, previous_summary_id - 1, previous_summary_id)
 
 
 # Image processing
-def get_generated_image(prompt, number_of_pictures=1, size="1024x1024"):
-    response = openai.Image.create(
+async def get_generated_image(prompt, number_of_pictures=1, size=DEFAULT_IMAGE_SIZE):
+    model_name = IMAGE_MODELS["dall-e"]["model"]
+    response = await call_with_retries(lambda: get_openai().Image.acreate(
         prompt=prompt,
         n=number_of_pictures,
         size=size
-    )
+    ), model_name, OPENAI_TIMEOUT_SECONDS[model_name])
     return response["data"][0]["url"]
 
 
+@metrics.timed("image_generation")
+async def get_generated_images(prompt, count, size=DEFAULT_IMAGE_SIZE):
+    """Generate count images with concurrent single-image requests, each as fast as one image."""
+    return await asyncio.gather(*[get_generated_image(prompt, 1, size) for _ in range(count)])
+
+
+def parse_image_args(args):
+    """Split "/image [count] [size] prompt" arguments into (count, size, prompt).
+
+    The size is given as 256, 512 or 1024, or WxH.
+    """
+    count, size = 1, DEFAULT_IMAGE_SIZE
+    sizes = IMAGE_MODELS["dall-e"]["prices_by_size"]
+    args = list(args)
+    while args:
+        if args[0].isdigit() and 1 <= int(args[0]) <= IMAGE_MAX_COUNT:
+            count = int(args.pop(0))
+        elif args[0] in sizes:
+            size = args.pop(0)
+        elif args[0] + "x" + args[0] in sizes:
+            size = args[0] + "x" + args.pop(0)
+        else:
+            break
+    return count, size, " ".join(args).strip()
+
+
 # Voice processing
-def transcribe(ogg_audio_bytes):
-    mp3_bytes = convert_ogg_to_mp3(ogg_audio_bytes)
-    mp3_bytes.name = "filename.mp3"  # required by transcribe method
-    return openai.Audio.transcribe(model=VOICE_MODELS["whisper"]["model"], file=mp3_bytes)["text"]
+async def transcribe(audio_bytes, mime_type="audio/ogg"):
+    filename = WHISPER_UPLOAD_FILENAMES.get(mime_type)
+    if filename is None:
+        # Only containers Whisper can't read are converted, Telegram voice notes are uploaded as they are
+        audio_bytes = await convert_to_mp3(audio_bytes)
+        filename = WHISPER_UPLOAD_FILENAMES["audio/mpeg"]
+    model_name = VOICE_MODELS["whisper"]["model"]
+    response = await call_with_retries(lambda: get_openai().Audio.atranscribe_raw(
+        model=model_name, file=audio_bytes, filename=filename), model_name, OPENAI_TIMEOUT_SECONDS[model_name])
+    return response["text"]
+
+
+@metrics.timed("transcription")
+async def transcribe_voice(audio_bytes, mime_type, duration):
+    """Transcribe a voice note, splitting long ones in chunks transcribed concurrently and joined back in order."""
+    is_long = duration > LONG_VOICE_SECONDS or len(audio_bytes) > WHISPER_MAX_UPLOAD_BYTES
+    if is_long and mime_type == "audio/ogg":
+        if shutil.which(FFMPEG_BINARY):
+            chunks = await split_on_silences(audio_bytes, duration)
+            if len(chunks) > 1:
+                print("Transcribing the voice note in " + str(len(chunks)) + " chunks")
+                semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+                async def transcribe_chunk(chunk):
+                    async with semaphore:
+                        return await transcribe(chunk, mime_type)
+                texts = await asyncio.gather(*[transcribe_chunk(chunk) for chunk in chunks])
+                return " ".join(text.strip() for text in texts if text.strip())
+        else:
+            logger.warning("ffmpeg is not available, transcribing the long voice note in one request")
+    return await transcribe(audio_bytes, mime_type)
+
+
+async def split_on_silences(ogg_bytes, duration):
+    silences = await detect_silences(ogg_bytes)
+    cut_points = choose_cut_points(silences, duration)
+    if not cut_points:
+        return [ogg_bytes]
+    with tempfile.TemporaryDirectory() as chunks_folder:
+        # Packets are copied as they are, the chunks are not re-encoded
+        await run_ffmpeg(ogg_bytes, "-i", "pipe:0", "-map", "0:a", "-c", "copy", "-f", "segment",
+                         "-segment_times", ",".join("%.2f" % cut for cut in cut_points),
+                         os.path.join(chunks_folder, "chunk%03d.ogg"))
+        chunks = []
+        for name in sorted(os.listdir(chunks_folder)):
+            with open(os.path.join(chunks_folder, name), "rb") as f:
+                chunks.append(f.read())
+        return chunks
+
+
+async def detect_silences(audio_bytes):
+    """Return the (start, end) seconds of every silence in the audio."""
+    output = await run_ffmpeg(audio_bytes, "-nostats", "-loglevel", "info", "-i", "pipe:0",
+                              "-af", VOICE_SILENCE_FILTER, "-f", "null", "-", capture_log=True)
+    starts = [float(value) for value in re.findall(r"silence_start: (-?[\d.]+)", output)]
+    ends = [float(value) for value in re.findall(r"silence_end: ([\d.]+)", output)]
+    return list(zip(starts, ends))
+
+
+def choose_cut_points(silences, duration):
+    midpoints = [(start + end) / 2 for start, end in silences]
+    cut_points = []
+    last_cut = 0
+    while duration - last_cut > VOICE_CHUNK_MAX_SECONDS:
+        candidates = [point for point in midpoints
+                      if last_cut + VOICE_CHUNK_MIN_SECONDS <= point <= last_cut + VOICE_CHUNK_MAX_SECONDS]
+        if candidates:
+            last_cut = min(candidates, key=lambda point: abs(point - last_cut - VOICE_CHUNK_SECONDS))
+        else:
+            # No pause long enough, cutting in the middle of a word is better than an oversized chunk
+            last_cut += VOICE_CHUNK_SECONDS
+        cut_points.append(last_cut)
+    return cut_points
+
 
+async def run_ffmpeg(input_bytes, *args, capture_log=False):
+    """Run ffmpeg with input_bytes piped to stdin, returns stdout bytes or the log text with capture_log."""
+    log_level = [] if capture_log else ["-loglevel", "error"]
+    async with ffmpeg_slots:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_BINARY, "-hide_banner", *log_level, *args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = await process.communicate(input=input_bytes)
+    if process.returncode != 0:
+        raise Exception("ffmpeg failed: " + errors.decode(errors="replace"))
+    if capture_log:
+        return errors.decode(errors="replace")
+    return output
 
-def convert_ogg_to_mp3(ogg_bytes):
-    audio_file = io.BytesIO(ogg_bytes)
-    # Read the OGG file from the message into an AudioSegment object
-    audio_data = AudioSegment.from_ogg(audio_file)
-    # Convert the audio to MP3 format
-    mp3_data = io.BytesIO(audio_data.export(format="mp3").read())
-    return mp3_data
+
+async def convert_to_mp3(audio_bytes):
+    # ffmpeg reads and writes through pipes, no temporary files or intermediate decoded copies
+    return await run_ffmpeg(audio_bytes, "-i", "pipe:0", "-f", "mp3", "pipe:1")
 
 
 ################# USERS ACTIONS ##############################
@@ -345,41 +1054,57 @@ async def start(update: Update, context: CallbackContext):
 
 # /add_user handler
 async def add_user(update: Update, context: CallbackContext):
-    if admin_user(str(update.message.from_user.id)):
-        _add_allowed_user(context.args[0], TYPE_ITEM_USER)
-        create_initial_config(context.args[0], MODELS["gpt3"])
+    if await run_io(admin_user, str(update.message.from_user.id)):
+        await asyncio.gather(
+            run_io(_add_allowed_user, context.args[0], TYPE_ITEM_USER),
+            run_io(create_initial_config, context.args[0], MODELS["gpt3"])
+        )
     else:
         await update.message.reply_text("You should be an Admin to perform this operation")
-    await users(update, context)
+    await send_users(update)
 
 
 # /delete_user handler
 async def delete_user(update: Update, context: CallbackContext):
-    if admin_user(str(update.message.from_user.id)):
+    if await run_io(admin_user, str(update.message.from_user.id)):
         user_id = context.args[0]
-        users_table.delete_item(
-            Key={"user_id": user_id, "user_type": TYPE_ITEM_USER})
-        config_table.delete_item(Key={"user_id": user_id})
+        await asyncio.gather(
+            run_io(_delete_allowed_user, user_id, TYPE_ITEM_USER),
+            run_io(delete_config, user_id)
+        )
         await update.message.reply_text("User " + user_id + " deleted!")
     else:
         await update.message.reply_text("You should be an Admin to perform this operation")
-    await users(update, context)
+    await send_users(update)
+
+
+def get_allowed_users():
+    allowed_users = roster_cache.get(TYPE_ITEM_USER)
+    if allowed_users is MISSING:
+        allowed_users = get_storage().list_users(TYPE_ITEM_USER)
+        roster_cache.set(TYPE_ITEM_USER, allowed_users)
+    return allowed_users
 
 
-# /users handler
+# /users handler, /users 2 shows the second page of USERS_PAGE_SIZE users
 async def users(update: Update, context: CallbackContext):
-    if allowed_user(str(update.message.from_user.id)):
-        response = users_table.scan(
-            FilterExpression=boto3.dynamodb.conditions.Attr(
-                "user_type").eq(TYPE_ITEM_USER)
-        )
-        allowed_users = [item["user_id"] for item in response["Items"]]
+    await send_users(update, int(context.args[0]) if context.args and context.args[0].isdigit() else 1)
+
+
+async def send_users(update: Update, page=1):
+    if await run_io(allowed_user, str(update.message.from_user.id)):
+        allowed_users = await run_io(get_allowed_users)
+        pages = max(1, math.ceil(len(allowed_users) / USERS_PAGE_SIZE))
+        page = min(max(page, 1), pages)
+        first = (page - 1) * USERS_PAGE_SIZE
         response_strings = ""
-        for i, user in enumerate(allowed_users):
+        for i, user in enumerate(allowed_users[first:first + USERS_PAGE_SIZE], start=first):
             response_strings += str(i+1) + " " + str(user) + "\n"
-        await update.message.reply_text(response_strings)
+        if pages > 1:
+            response_strings += "Page " + str(page) + " of " + str(pages) + ", /users <page> for another one"
+        await update.message.reply_text(response_strings or "No users")
     else:
-        await update.message.reply_text()
+        await update.message.reply_text(PERMISSION_ERROR_TEXT)
 
 
 #################### MESSAGE PROCESSING ###########################
@@ -387,34 +1112,94 @@ async def users(update: Update, context: CallbackContext):
 async def handle_text(update: Update, context: CallbackContext):
     user_text = update.message.text
     user_id = str(update.message.from_user.id)
-    store_message(user_id, update.message.id, "user", user_text)
-    if allowed_user(user_id):
-        response_text, tokens = process_text(
-            user_text, user_id, update.message.id)
-        await update.message.reply_text(text=response_text,  parse_mode=ParseMode.MARKDOWN)
-        print("Price: " + str(get_price(tokens, user_id)))
-        await update.message.reply_text(text="Last request used " + str(tokens["total_tokens"]) + " tokens. It costed " + str(get_price(tokens, user_id)) + " USD")
-    else:
+    message_id = update.message.id
+    owner = str(update.update_id)
+    store_user_message = asyncio.ensure_future(run_io(store_message, user_id, message_id, "user", user_text))
+    try:
+        allowed, (acquired, answered_up_to) = await asyncio.gather(
+            run_io(allowed_user, user_id),
+            run_io(acquire_turn, user_id, owner)
+        )
+    finally:
+        await store_user_message
+    if not allowed:
+        if acquired:
+            await run_io(release_turn, user_id, owner, None)
         await update.message.reply_text(PERMISSION_ERROR_TEXT)
+        return
+    if not acquired:
+        # The running turn may have ended before the message was stored, without seeing it
+        acquired, answered_up_to = await run_io(acquire_turn, user_id, owner)
+    if acquired:
+        await answer_in_turns(context.bot, update.message.chat_id, user_id, owner,
+                              message_id - 1 if answered_up_to is None else answered_up_to)
+    # Otherwise the running turn answers this message once it is done with its own
+
+
+async def answer_in_turns(bot, chat_id, user_id, owner, answered_up_to):
+    """Answer the pending messages of the user while holding their turn, a burst of messages gets one answer.
+
+    The turn is a conditional write in the storage, so a single invocation answers a user at a time
+    across containers, and the answered messages are remembered in it.
+    """
+    while True:
+        pending = await run_io(get_pending_messages, user_id, answered_up_to)
+        lease = asyncio.ensure_future(keep_turn(user_id, owner))
+        try:
+            if pending:
+                # Marked as answered up front, so a failed answer isn't retried with every later message
+                answered_up_to = pending[-1]["message_id"]
+                await process_text(bot, chat_id, "\n\n".join(msg["text"] for msg in pending), user_id,
+                                   pending[0]["message_id"])
+        finally:
+            lease.cancel()
+            await run_io(release_turn, user_id, owner, answered_up_to)
+        # Invocations that found the turn taken left their messages to it
+        if not await run_io(get_pending_messages, user_id, answered_up_to):
+            return
+        acquired, stored_answered_up_to = await run_io(acquire_turn, user_id, owner)
+        if not acquired:
+            return
+        if stored_answered_up_to is not None:
+            answered_up_to = stored_answered_up_to
+
+
+def get_voice_processing_markup():
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text=text, callback_data=data) for text, data in row]
+                                 for row in VOICE_PROCESSING_KEYBOARD])
 
 
 # Voice message handler
 async def voice_to_text(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    if allowed_user(user_id):
-        voice = update.message.voice
+    voice = update.message.voice
+    # Assuming `voice_message` is a Telegram `Voice` message object
+    audio_file = voice.file_id
+    # Resolve the download link from Telegram servers while the permissions and the transcript cache are checked,
+    # a cached voice note then skips the download and Whisper
+    allowed, cached, file = await asyncio.gather(
+        run_io(allowed_user, user_id),
+        run_io(get_cached_transcript, voice.file_unique_id),
+        context.bot.get_file(audio_file)
+    )
+    if allowed:
+        reply_markup = get_voice_processing_markup()
+        if cached is not None:
+            # Already paid for when it was first transcribed
+            await update.message.reply_text(cached["text"] + "\n" + "Is that what you told? \n Processing costed: 0 USD",
+                                            reply_markup=reply_markup)
+            return
         duration = voice.duration
-        # Assuming `voice_message` is a Telegram `Voice` message object
-        audio_file = voice.file_id
-        # Download the audio file from Telegram servers
-        file = await context.bot.get_file(audio_file)
         audio_data = await file.download_as_bytearray()
-        text = transcribe(audio_data)
+        # Telegram voice notes are always OGG/Opus, even when no mime type is reported
+        text = await transcribe_voice(audio_data, voice.mime_type or "audio/ogg", duration)
         processing_cost = math.ceil(duration * VOICE_MODELS["whisper"]["price_per_minute"] / 60)
-        add_image_voice_spending(
-            user_id, processing_cost, VOICE_MODELS["whisper"]["model"])
-        reply_markup = InlineKeyboardMarkup(VOICE_PROCESSING_KEYBOARD)
-        await update.message.reply_text(text + "\n" + "Is that what you told? \n Processing costed: " + str(processing_cost / 1000 / 60) + " USD", reply_markup=reply_markup)
+        await asyncio.gather(
+            run_io(add_image_voice_spending, user_id, processing_cost, VOICE_MODELS["whisper"]["model"]),
+            run_io(cache_transcript, voice.file_unique_id, text, duration),
+            update.message.reply_text(text + "\n" + "Is that what you told? \n Processing costed: " + str(processing_cost / 1000 / 60) + " USD", reply_markup=reply_markup)
+        )
     else:
         await update.message.reply_text(PERMISSION_ERROR_TEXT)
 
@@ -422,27 +1207,56 @@ async def voice_to_text(update: Update, context: CallbackContext):
 # /clear handler
 async def clear(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    if allowed_user(user_id):
-        delete_messages(update.message.from_user.id)
+    if await run_io(allowed_user, user_id):
+        message_id = update.message.message_id
+        await run_io(clear_history, user_id, message_id)
         logger.info("Context should be cleared by now")
         await update.message.reply_text("Context cleared")
+        # The cleared messages are no longer read, deleting them can wait until the user has the answer
+        await run_io(reap_cleared_messages, user_id, message_id)
     else:
         await update.message.reply_text(PERMISSION_ERROR_TEXT)
 
 
+async def send_photos(message, photos):
+    """Reply with the photos (URLs or Telegram file ids) as one album and return their file ids."""
+    from telegram import InputMediaPhoto
+    if len(photos) == 1:
+        sent = [await message.reply_photo(photos[0])]
+    else:
+        sent = await message.reply_media_group([InputMediaPhoto(photo) for photo in photos])
+    return [sent_message.photo[-1].file_id for sent_message in sent]
+
+
 # /image handler
 async def generate_image(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    if allowed_user(user_id):
-        prompt = " ".join(context.args).strip()
-        if prompt:
-            url = get_generated_image(prompt)
-            await update.message.reply_html(url)
-            add_image_voice_spending(
-                user_id, IMAGE_MODELS["dall-e"]["response_price"], IMAGE_MODELS["dall-e"]["model"])
-            await update.message.reply_text("Image generation costed:" + str(IMAGE_MODELS["dall-e"]["response_price"]/1000) + " USD")
-        else:
-            await update.message.reply_text("Please provide the text prompt")
+    count, size, prompt = parse_image_args(context.args)
+    if not prompt:
+        allowed = await run_io(allowed_user, user_id)
+        await update.message.reply_text("Please provide the text prompt" if allowed else PERMISSION_ERROR_TEXT)
+        return
+    cache_key = get_image_cache_key(prompt, size)
+    allowed, cached = await asyncio.gather(
+        run_io(allowed_user, user_id),
+        run_io(get_cached_images, cache_key)
+    )
+    if allowed:
+        # Cached photos are sent again by file id, only the missing ones are generated and paid for
+        cached = cached[:count]
+        urls = await get_generated_images(prompt, count - len(cached), size) if len(cached) < count else []
+        file_ids = await send_photos(update.message, cached + urls)
+        price = len(urls) * IMAGE_MODELS["dall-e"]["prices_by_size"][size]
+        background = []
+        if urls:
+            background = [
+                run_io(add_image_voice_spending, user_id, price, IMAGE_MODELS["dall-e"]["model"]),
+                run_io(cache_images, cache_key, file_ids)
+            ]
+        await asyncio.gather(
+            update.message.reply_text("Image generation costed: " + str(price / 1000) + " USD"),
+            *background
+        )
     else:
         await update.message.reply_text(PERMISSION_ERROR_TEXT)
 
@@ -450,39 +1264,55 @@ async def generate_image(update: Update, context: CallbackContext):
 # /model handler
 async def choose_model(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    if admin_user(user_id):
-        model = get_config(user_id)
+    is_admin, model = await asyncio.gather(
+        run_io(admin_user, user_id),
+        run_io(get_config, user_id)
+    )
+    if is_admin:
         if len(context.args) == 0:
             await update.message.reply_text("Your current model is: " + model["model"])
         else:
             new_model_name = context.args[0]
             if new_model_name in MODELS.keys():
-                await update.message.reply_text("Model changed to " + new_model_name)
-                update_config(user_id, MODELS[new_model_name])
+                await asyncio.gather(
+                    update.message.reply_text("Model changed to " + new_model_name),
+                    run_io(update_config, user_id, MODELS[new_model_name])
+                )
             else:
-                await update.message.reply_text("Model not found \n Your current model: " + get_config(user_id)["model"])
+                await update.message.reply_text("Model not found \n Your current model: " + model["model"])
     else:
-        await update.message.reply_text("Your current model is: " + get_config(user_id)["model"] + "\n" + PERMISSION_ERROR_TEXT)
+        await update.message.reply_text("Your current model is: " + model["model"] + "\n" + PERMISSION_ERROR_TEXT)
 
 
 # spendings handler
 async def get_total_spending(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
-    spending = get_spendings_for_user(user_id)
-    await update.message.reply_text("Your total spendings: " + str(spending) + " USD")
+    spending, month_spending = await run_io(get_spendings_for_user, user_id)
+    await update.message.reply_text("Your total spendings: " + str(spending) + " USD\nThis month: " + str(month_spending) + " USD")
 
 
 # all spendings handler
 async def get_all_users_spending(update: Update, context: CallbackContext):
     user_id = str(update.message.from_user.id)
     if user_id == ADMIN_ID:
-        spendings_by_user = get_all_spendings()
+        spendings_by_user = await run_io(get_all_spendings)
         for user_id, total_spendings in spendings_by_user.items():
             await update.message.reply_text(f"{user_id}: total spendings {total_spendings / 1000} USD")
     else:
         await update.message.reply_text(PERMISSION_ERROR_TEXT)
 
 
+# /rebuild_spendings handler
+async def rebuild_spendings(update: Update, context: CallbackContext):
+    user_id = str(update.message.from_user.id)
+    if user_id == ADMIN_ID:
+        await update.message.reply_text("Rebuilding spending totals...")
+        totals = await run_io(rebuild_spending_totals)
+        await update.message.reply_text("Spending totals rebuilt for " + str(len(totals)) + " users")
+    else:
+        await update.message.reply_text(PERMISSION_ERROR_TEXT)
+
+
 # Callback handler
 async def process_callback(update: Update, context: CallbackContext):
     query = update.callback_query
@@ -491,60 +1321,205 @@ async def process_callback(update: Update, context: CallbackContext):
     message_id = query.message.message_id
     print("Inline message id: " + str(message_id))
     message = query.message.text.splitlines()[0]
-    await query.answer()
-    await query.edit_message_text(message)
+    await asyncio.gather(
+        query.answer(),
+        query.edit_message_text(message)
+    )
 
     if query.data == CALLBACK_CORRECT_TRANSCRIPT:
-        response, tokens_used = process_text(message, user_id, message_id)
-        await context.bot.send_message(chat_id=chat_id, text=response)
-        await context.bot.send_message(chat_id=chat_id, text="Last request used " + str(tokens_used["total_tokens"]) + " tokens. It costed " + str(get_price(tokens_used, user_id)) + " USD")
+        await process_text(context.bot, chat_id, message, user_id, message_id)
     elif query.data == CALLBACK_WRONG_TRANSCRIPT:
         pass
 
 
 ###################### MAIN ##########################################
+# Warm Lambda containers reuse the event loop and the initialised application, so the Telegram
+# connection pool and the getMe round-trip of application.initialize() survive between invocations
+event_loop = None
+application = None
+bootstrapped = False
+update_queue = None
+
+
 @app.lambda_function(name=LAMBDA_MESSAGE_HANDLER)
 def message_handler(event, context):
-    if not is_config_present(ADMIN_ID):
-        create_initial_config(ADMIN_ID, MODELS["gpt3"])
-    _add_allowed_user(ADMIN_ID, ADMIN_USER_KEY)
-    _add_allowed_user(ADMIN_ID, TYPE_ITEM_USER)
-    return asyncio.run(run_bot_application(event))
+    if UPDATE_QUEUE != "lambda":
+        bootstrap()
+    return run_until_deadline(handle_webhook(event), context)
 
 
-async def run_bot_application(event):
-    application = Application.builder().token(TELEGRAM_API_TOKEN).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("clear", clear))
-    application.add_handler(CommandHandler("add_user", add_user))
-    application.add_handler(CommandHandler("users", users))
-    application.add_handler(CommandHandler("delete_user", delete_user))
-    application.add_handler(CommandHandler("image", generate_image))
-    application.add_handler(CommandHandler("model", choose_model))
-    application.add_handler(CommandHandler("spendings", get_total_spending))
-    application.add_handler(CommandHandler("spendings_all", get_all_users_spending))
-    application.add_handler(MessageHandler(filters.VOICE, voice_to_text))
-    application.add_handler(CallbackQueryHandler(process_callback))
-    application.add_handler(MessageHandler(
+# Processes the updates enqueued by message_handler when UPDATE_QUEUE is "lambda"
+@app.lambda_function(name=LAMBDA_UPDATE_WORKER)
+def update_worker(event, context):
+    bootstrap()
+    return run_until_deadline(run_bot_application(event), context)
+
+
+def run_until_deadline(coroutine, context):
+    """Run coroutine on the warm event loop, its OpenAI requests ending LAMBDA_DEADLINE_MARGIN_SECONDS before
+    the invocation times out."""
+    token = set_deadline(context.get_remaining_time_in_millis() / 1000 - LAMBDA_DEADLINE_MARGIN_SECONDS)
+    try:
+        return get_event_loop().run_until_complete(coroutine)
+    finally:
+        reset_deadline(token)
+
+
+def bootstrap():
+    """Seed the admin user once per table set instead of on every update.
+
+    A single read of the seed version stored for the configured admin is done per cold start, the
+    seeding writes only happen when it is older than BOOTSTRAP_VERSION or the admin changed.
+    """
+    global bootstrapped
+    if bootstrapped:
+        return
+    if get_bootstrap_version() < BOOTSTRAP_VERSION:
+        print("Seeding admin user, bootstrap version " + str(BOOTSTRAP_VERSION))
+        if not is_config_present(ADMIN_ID):
+            create_initial_config(ADMIN_ID, MODELS["gpt3"])
+        _add_allowed_user(ADMIN_ID, ADMIN_USER_KEY)
+        _add_allowed_user(ADMIN_ID, TYPE_ITEM_USER)
+        store_bootstrap_version(BOOTSTRAP_VERSION)
+    bootstrapped = True
+
+
+def get_event_loop():
+    global event_loop
+    if event_loop is None or event_loop.is_closed():
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+    return event_loop
+
+
+def build_application(telegram_request=None, update_processor=None):
+    """Build the bot application, which gets the updates from the webhook Lambdas one at a time.
+
+    With an update_processor (see server.py), it fetches the updates itself through its updater
+    and processes them concurrently with it.
+    """
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+    from telegram.request import HTTPXRequest
+    if telegram_request is None:
+        telegram_request = HTTPXRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE)
+    builder = Application.builder().token(TELEGRAM_API_TOKEN).request(telegram_request)
+    if update_processor is None:
+        builder = builder.updater(None)
+    else:
+        builder = builder.concurrent_updates(update_processor)
+    bot_application = builder.build()
+    bot_application.add_handler(CommandHandler("start", start))
+    bot_application.add_handler(CommandHandler("clear", clear))
+    bot_application.add_handler(CommandHandler("add_user", add_user))
+    bot_application.add_handler(CommandHandler("users", users))
+    bot_application.add_handler(CommandHandler("delete_user", delete_user))
+    bot_application.add_handler(CommandHandler("image", generate_image))
+    bot_application.add_handler(CommandHandler("model", choose_model))
+    bot_application.add_handler(CommandHandler("spendings", get_total_spending))
+    bot_application.add_handler(CommandHandler("spendings_all", get_all_users_spending))
+    bot_application.add_handler(CommandHandler("rebuild_spendings", rebuild_spendings))
+    bot_application.add_handler(MessageHandler(filters.VOICE, voice_to_text))
+    bot_application.add_handler(CallbackQueryHandler(process_callback))
+    bot_application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND, handle_text))
+    bot_application.add_error_handler(handle_error)
     print("Registered all the handlers")
-    print("Try to initialise")
-    await application.initialize()
-    print("Got something from Telegram: " + str(event))
+    return bot_application
+
+
+async def get_application():
+    global application
+    if application is None:
+        bot_application = build_application()
+        print("Try to initialise")
+        await bot_application.initialize()
+        application = bot_application
+    return application
+
+
+def get_update_queue():
+    global update_queue
+    if update_queue is None:
+        if UPDATE_QUEUE == "lambda":
+            update_queue = LambdaUpdateQueue(get_worker_function_name(LAMBDA_MESSAGE_HANDLER, LAMBDA_UPDATE_WORKER),
+                                             io_executor)
+        elif UPDATE_QUEUE == "local":
+            update_queue = LocalUpdateQueue(run_bot_application)
+        else:
+            raise Exception("Unknown update queue: " + UPDATE_QUEUE)
+    return update_queue
+
+
+async def handle_webhook(event):
+    """Process the update right away or, with an UPDATE_QUEUE, only validate and enqueue it.
+
+    Enqueueing answers Telegram within milliseconds, so slow answers no longer make it re-deliver the update.
+    """
+    if UPDATE_QUEUE == "inline":
+        return await run_bot_application(event)
+    try:
+        update = json.loads(event["body"])
+    except (KeyError, TypeError, ValueError):
+        return {"statusCode": 400}
+    if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+        return {"statusCode": 400}
+    if "message" in event["body"]:
+        try:
+            await get_update_queue().put(event)
+        except Exception as e:
+            # Telegram retries the update, the worker dedupes it if the first attempt got through
+            logger.exception("Could not enqueue the update: " + str(e))
+            return {"statusCode": 500}
+    return {"statusCode": 200}
+
+
+# Handlers errors are caught by the application, they end up here instead of in run_bot_application
+async def handle_error(update: object, context: CallbackContext):
+    logger.error("Exception while handling an update", exc_info=context.error)
+    metrics.increment("errors")
+
+
+def get_update_type(update):
+    if update.callback_query:
+        return "callback"
+    message = update.message
+    if message is None:
+        return "other"
+    if message.voice:
+        return "voice"
+    if message.text and message.text.startswith("/"):
+        return "command"
+    return "text" if message.text else "other"
+
+
+async def run_bot_application(event):
+    """Process one webhook event, then print its metrics record (see chalicelib/metrics.py)."""
+    record = metrics.start_update(cold_start=application is None)
     try:
-        print("Trying to process the update")
         if "message" in event["body"]:
-            print("Preparing the update")
+            from telegram import Update
+            with metrics.phase("init"):
+                bot_application = await get_application()
             update = Update.de_json(data=json.loads(
-                event["body"]), bot=application.bot)
-            await application.update_queue.put(update)
-            print("Let's process the update: " + str(update))
-            await application.process_update(update)
-            print("Update processed")
+                event["body"]), bot=bot_application.bot)
+            record.update_type = get_update_type(update)
+            record.properties["update_id"] = update.update_id
+            if update.effective_user:
+                record.properties["user_id"] = str(update.effective_user.id)
+            # Re-deliveries of Telegram and retries of the worker Lambda are dropped. An update whose first
+            # attempt failed is not processed again, better than answering and billing it twice.
+            if not await run_io(claim_update, update.update_id):
+                record.update_type = "duplicate"
+                return {"statusCode": 200}
+            # The update is processed right away, putting it into the never consumed
+            # update_queue as well would only grow it across warm invocations
+            await bot_application.process_update(update)
         else:
-            print("Not a message event")
+            record.update_type = "ignored"
     except Exception as e:
-        logger.warning(e)
-        print("Exception happened: " + e)
+        logger.exception("Exception happened: " + str(e))
+        record.increment("errors")
         return {"statusCode": 500}
+    finally:
+        metrics.emit(record)
     return {"statusCode": 200}
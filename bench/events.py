@@ -0,0 +1,103 @@
+"""Webhook events for the benchmark: synthetic Telegram updates or recorded ones replayed from a file."""
+import itertools
+import json
+import random
+import time
+
+DEFAULT_MIX = {"text": 0.7, "voice": 0.1, "callback": 0.1, "command": 0.1}
+COMMANDS = ["/spendings", "/model", "/users", "/start"]
+TEXTS = ["What is the capital of France?", "Write a haiku about the sea",
+         "Explain the difference between TCP and UDP in a few sentences", "Thanks!"]
+
+
+def parse_mix(mix):
+    """Parse "text=0.7,voice=0.1" into weights by event kind."""
+    weights = {}
+    for part in mix.split(","):
+        kind, weight = part.split("=")
+        if kind not in DEFAULT_MIX:
+            raise ValueError("Unknown event kind: " + kind)
+        weights[kind] = float(weight)
+    return weights
+
+
+def lambda_event(update):
+    return {"body": json.dumps(update)}
+
+
+class SyntheticEvents:
+    """Generates updates of users first_user_id.. first_user_id + users - 1, with increasing message ids per chat."""
+
+    def __init__(self, users, first_user_id=1, mix=None, seed=0):
+        self.user_ids = list(range(first_user_id, first_user_id + users))
+        self.mix = mix or DEFAULT_MIX
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = {user_id: 10 for user_id in self.user_ids}
+
+    def generate(self, count):
+        kinds = list(self.mix)
+        weights = [self.mix[kind] for kind in kinds]
+        for _ in range(count):
+            kind = self.random.choices(kinds, weights)[0]
+            user_id = self.random.choice(self.user_ids)
+            yield kind, lambda_event(getattr(self, kind)(user_id))
+
+    def message(self, user_id, **fields):
+        # Leave room for the bot replies between two messages of the user, as in a real chat
+        self.message_ids[user_id] += 4
+        user = {"id": user_id, "is_bot": False, "first_name": "User" + str(user_id)}
+        return dict({"message_id": self.message_ids[user_id], "date": int(time.time()), "from": user,
+                     "chat": {"id": user_id, "type": "private"}}, **fields)
+
+    def text(self, user_id):
+        return {"update_id": next(self.update_ids), "message": self.message(user_id, text=self.random.choice(TEXTS))}
+
+    def command(self, user_id):
+        command = self.random.choice(COMMANDS)
+        return {"update_id": next(self.update_ids), "message": self.message(
+            user_id, text=command, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])}
+
+    def voice(self, user_id):
+        file_id = "voice" + str(next(self.update_ids))
+        voice = {"file_id": file_id, "file_unique_id": "u" + file_id, "duration": self.random.randint(2, 60),
+                 "mime_type": "audio/ogg"}
+        return {"update_id": next(self.update_ids), "message": self.message(user_id, voice=voice)}
+
+    def callback(self, user_id):
+        # The bot message holding the transcript and its inline keyboard
+        transcript = self.message(user_id, text="Transcribed voice message\nIs that what you told?")
+        transcript["from"] = {"id": 1000000, "is_bot": True, "first_name": "Bench"}
+        return {"update_id": next(self.update_ids), "callback_query": {
+            "id": str(next(self.update_ids)), "chat_instance": str(user_id), "data": "correct_transcript",
+            "from": {"id": user_id, "is_bot": False, "first_name": "User" + str(user_id)},
+            "message": transcript}}
+
+
+def recorded_events(path, count=None):
+    """Replay a JSON lines file of Lambda events ({"body": ...}) or raw updates, cycling up to count events."""
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if not events:
+        return
+    for i, event in enumerate(itertools.cycle(events)):
+        if count is not None and i >= count:
+            return
+        if i >= len(events) and count is None:
+            return
+        update = json.loads(event["body"]) if "body" in event else event
+        if i >= len(events):
+            # Replayed copies get new update ids, the bot drops re-delivered ones
+            update = dict(update, update_id=update.get("update_id", 0) + i // len(events) * 1000000000)
+        yield event_kind(update), lambda_event(update)
+
+
+def event_kind(update):
+    if "callback_query" in update:
+        return "callback"
+    message = update.get("message", {})
+    if "voice" in message:
+        return "voice"
+    if message.get("text", "").startswith("/"):
+        return "command"
+    return "text"
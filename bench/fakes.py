@@ -0,0 +1,173 @@
+"""Local stand-ins for the Telegram Bot API, OpenAI and the storage backend used by the benchmark."""
+import asyncio
+import contextvars
+import json
+import threading
+import time
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+# Smallest valid OGG page, the fake Whisper never decodes it
+VOICE_BYTES = b"OggS" + bytes(60)
+
+# Storage calls of the update being processed, see CountingStorage
+update_calls = contextvars.ContextVar("update_calls", default=None)
+# Ids for the messages sent while processing an update, so that they follow the user message in the chat
+# like in Telegram (the synthetic events leave room for them)
+reply_message_ids = contextvars.ContextVar("reply_message_ids", default=None)
+
+
+class FakeBotRequest(BaseRequest):
+    """Answers Bot API requests locally after an optional latency, counting the calls by API method."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+        self.next_message_id = 1000000
+        self.lock = threading.Lock()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if "/file/bot" in url:
+            self.count("downloadFile")
+            return 200, VOICE_BYTES
+        api_method = url.rsplit("/", 1)[-1]
+        self.count(api_method)
+        parameters = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self.result(api_method, parameters)}).encode()
+
+    def count(self, api_method):
+        with self.lock:
+            self.calls[api_method] = self.calls.get(api_method, 0) + 1
+
+    def result(self, api_method, parameters):
+        if api_method == "getMe":
+            return dict(BOT_USER, can_join_groups=False, can_read_all_group_messages=False, supports_inline_queries=False)
+        if api_method == "getFile":
+            return {"file_id": parameters["file_id"], "file_unique_id": "u" + parameters["file_id"],
+                    "file_size": len(VOICE_BYTES), "file_path": "voice/" + parameters["file_id"] + ".oga"}
+        if api_method in ("sendMessage", "editMessageText"):
+            with self.lock:
+                self.next_message_id += 1
+                message_ids = reply_message_ids.get()
+                message_id = parameters.get("message_id", next(message_ids) if message_ids else self.next_message_id)
+            return {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                    "chat": {"id": parameters.get("chat_id", 0), "type": "private"}, "text": parameters.get("text", "")}
+        if api_method == "sendPhoto":
+            return self.photo_message(parameters["chat_id"])
+        if api_method == "sendMediaGroup":
+            return [self.photo_message(parameters["chat_id"]) for _ in parameters["media"]]
+        return True
+
+    def photo_message(self, chat_id):
+        with self.lock:
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        file_id = "photo" + str(message_id)
+        return {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                "chat": {"id": chat_id, "type": "private"},
+                "photo": [{"file_id": file_id, "file_unique_id": "u" + file_id, "width": 1024, "height": 1024}]}
+
+
+class FakeOpenAI:
+    """Replaces the openai calls used by the bot with local fakes of configurable latency and usage."""
+
+    def __init__(self, latency=0.5, token_interval=0.0, completion_tokens=50, transcription_latency=0.3,
+                 image_latency=2.0):
+        self.latency = latency
+        self.token_interval = token_interval
+        self.completion_tokens = completion_tokens
+        self.transcription_latency = transcription_latency
+        self.image_latency = image_latency
+        self.calls = {}
+        self.originals = {}
+
+    def install(self):
+        import openai
+        self.originals = {
+            (openai.ChatCompletion, "acreate"): openai.ChatCompletion.acreate,
+            (openai.Audio, "atranscribe_raw"): openai.Audio.atranscribe_raw,
+            (openai.Image, "acreate"): openai.Image.acreate,
+        }
+        openai.ChatCompletion.acreate = self.chat_completion
+        openai.Audio.atranscribe_raw = self.transcription
+        openai.Image.acreate = self.image
+
+    def uninstall(self):
+        for (owner, name), original in self.originals.items():
+            setattr(owner, name, original)
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def chat_completion(self, model, messages, stream=False, **params):
+        from openai.openai_object import OpenAIObject
+        self.count("chat_completion")
+        usage = {"prompt_tokens": sum(len(message["content"]) // 4 + 4 for message in messages),
+                 "completion_tokens": self.completion_tokens}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        words = ["word"] * self.completion_tokens
+        await asyncio.sleep(self.latency)
+        if not stream:
+            await asyncio.sleep(self.token_interval * len(words))
+            return OpenAIObject.construct_from({
+                "model": model, "usage": usage,
+                "choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]})
+
+        async def chunks():
+            for word in words:
+                yield OpenAIObject.construct_from({"choices": [{"delta": {"content": word + " "}}], "usage": None})
+                if self.token_interval:
+                    await asyncio.sleep(self.token_interval)
+            yield OpenAIObject.construct_from({"choices": [], "usage": usage})
+        return chunks()
+
+    async def transcription(self, model, file, filename, **params):
+        from openai.openai_object import OpenAIObject
+        self.count("transcription")
+        await asyncio.sleep(self.transcription_latency)
+        return OpenAIObject.construct_from({"text": "Transcribed voice message"})
+
+    async def image(self, prompt, n=1, size="1024x1024", **params):
+        from openai.openai_object import OpenAIObject
+        self.count("image")
+        await asyncio.sleep(self.image_latency)
+        return OpenAIObject.construct_from({"data": [{"url": "https://example.com/image.png"} for _ in range(n)]})
+
+
+class CountingStorage:
+    """Wraps a storage backend and counts its read and write calls, in total and per update."""
+
+    READ_PREFIXES = ("get_", "has_", "list_", "query_")
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.reads = 0
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def __getattribute__(self, name):
+        if name.startswith("_") or name in ("storage", "reads", "writes", "lock", "READ_PREFIXES", "count"):
+            return object.__getattribute__(self, name)
+        self.count("reads" if name.startswith(self.READ_PREFIXES) else "writes")
+        return getattr(self.storage, name)
+
+    def count(self, kind):
+        with self.lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+        calls = update_calls.get()
+        if calls is not None:
+            calls[kind] += 1
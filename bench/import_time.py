@@ -0,0 +1,65 @@
+"""Cold start budget check: imports app with `python -X importtime` in a fresh interpreter.
+
+Fails when the cumulative import time of app goes over the budget, or when one of the heavy
+dependencies, which are only needed on first use, is imported with the module.
+
+    python bench/import_time.py [--budget-ms 250]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+DEFAULT_BUDGET_MS = 250
+LAZY_MODULES = ["openai", "aiohttp", "boto3", "botocore", "telegram", "httpx"]
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$")
+
+
+def measure_imports():
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    env.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    # Children are reported before their parent, only the block ending with app belongs to it
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        name, is_top_level = match.group(4), len(match.group(3)) == 1
+        imports[name] = int(match.group(2))
+        if is_top_level and name == "app":
+            return imports
+        if is_top_level:
+            imports = {}
+    sys.exit("app was not imported")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    args = parser.parse_args()
+
+    imports = measure_imports()
+    total_ms = imports["app"] / 1000
+    print("import app: %.1f ms (budget %.1f ms)" % (total_ms, args.budget_ms))
+    for name, cumulative in sorted(imports.items(), key=lambda item: -item[1])[1:11]:
+        print("  %8.1f ms  %s" % (cumulative / 1000, name))
+
+    failures = []
+    eager = sorted(name for name in imports if name.split(".")[0] in LAZY_MODULES and "." not in name)
+    if eager:
+        failures.append("imported eagerly: " + ", ".join(eager))
+    if total_ms > args.budget_ms:
+        failures.append("import time over budget")
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""End-to-end benchmark of the webhook handler.
+
+Webhook events (synthetic or recorded) go through app.run_bot_application and the real handlers, with
+the Bot API, OpenAI and the storage replaced by the local stand-ins of bench/fakes.py. Reports latency
+percentiles, throughput, storage calls per update and memory, and writes them to a JSON file so that
+releases can be compared.
+
+    python -m bench.run --updates 500 --concurrency 20 --openai-latency 0.5 --output bench_results.json
+    python -m bench.run --events recorded.jsonl --storage dynamodb   # e.g. against DynamoDB Local
+"""
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("TELEGRAM_API_TOKEN", "123456:bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("BOT_ADMIN_USER_ID", "1")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import app  # noqa: E402
+from bench.events import SyntheticEvents, parse_mix, recorded_events, DEFAULT_MIX  # noqa: E402
+from bench.fakes import CountingStorage, FakeBotRequest, FakeOpenAI, reply_message_ids, update_calls  # noqa: E402
+from chalicelib import storage as storage_module  # noqa: E402
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=200, help="number of updates to replay")
+    parser.add_argument("--concurrency", type=int, default=1, help="updates processed at the same time")
+    parser.add_argument("--users", type=int, default=20, help="distinct users of the synthetic updates")
+    parser.add_argument("--mix", default=",".join(k + "=" + str(v) for k, v in DEFAULT_MIX.items()),
+                        help="weights of the synthetic update kinds: text, voice, callback, command")
+    parser.add_argument("--events", help="JSON lines file of recorded Lambda events or Telegram updates")
+    parser.add_argument("--storage", default="memory", choices=["memory", "sqlite", "dynamodb"])
+    parser.add_argument("--update-queue", default="inline", choices=["inline", "local"],
+                        help="process updates in the webhook call or acknowledge them and process them from a local queue")
+    parser.add_argument("--rate-limits", default=False, action=argparse.BooleanOptionalAction,
+                        help="apply the per user and per model rate limits, off to measure raw throughput")
+    parser.add_argument("--streaming", default=app.STREAMING_REPLIES, action=argparse.BooleanOptionalAction,
+                        help="stream the GPT answers")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--openai-token-interval", type=float, default=0.0, help="seconds between streamed tokens")
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--transcription-latency", type=float, default=0.3)
+    parser.add_argument("--image-latency", type=float, default=2.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per Bot API call")
+    parser.add_argument("--trace-memory", default=True, action=argparse.BooleanOptionalAction,
+                        help="track allocations with tracemalloc, which slows the run down")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--verbose", action="store_true", help="keep the bot prints and logs")
+    return parser.parse_args(argv)
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+    return {"count": len(ordered), "mean": sum(ordered) / len(ordered), "p50": percentile(50),
+            "p95": percentile(95), "p99": percentile(99), "max": ordered[-1]}
+
+
+def setup_storage(backend, user_ids):
+    storage = CountingStorage(storage_module.create_storage(backend))
+    storage_module.storage = storage
+    if backend == "dynamodb":
+        # Count the real DynamoDB requests too, including every page of a query
+        from chalicelib.storage.dynamodb import get_dynamodb
+        get_dynamodb().meta.client.meta.events.register("before-call.dynamodb", count_dynamodb_call)
+    app.bootstrap()
+    for user_id in user_ids:
+        if not app.allowed_user(user_id):
+            app._add_allowed_user(user_id, app.TYPE_ITEM_USER)
+            app.create_initial_config(user_id, app.MODELS["gpt3"])
+    storage.reads = storage.writes = 0
+    return storage
+
+
+def sender_id(update):
+    sender = (update.get("message") or update.get("callback_query") or {}).get("from")
+    return str(sender["id"]) if sender else None
+
+
+def count_dynamodb_call(**kwargs):
+    calls = update_calls.get()
+    if calls is not None:
+        calls["dynamodb_requests"] += 1
+
+
+async def process(kind, event, semaphore, results, errors):
+    async with semaphore:
+        calls = {"reads": 0, "writes": 0, "dynamodb_requests": 0}
+        update_calls.set(calls)
+        message = json.loads(event["body"]).get("message")
+        if message:
+            reply_message_ids.set(itertools.count(message["message_id"] + 1))
+        errors_before = len(errors)
+        started = time.perf_counter()
+        response = await app.handle_webhook(event)
+        latency = time.perf_counter() - started
+        failed = response.get("statusCode") != 200 or len(errors) > errors_before
+        results.append(dict(calls, kind=kind, latency_ms=latency * 1000, failed=failed))
+
+
+async def run(args, events, errors):
+    telegram = FakeBotRequest(latency=args.telegram_latency)
+    bot_application = app.build_application(telegram)
+
+    async def on_error(update, context):
+        errors.append(repr(context.error))
+    bot_application.add_error_handler(on_error)
+    started = time.perf_counter()
+    await bot_application.initialize()
+    app.application = bot_application
+    init_ms = (time.perf_counter() - started) * 1000
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+    started = time.perf_counter()
+    await asyncio.gather(*[process(kind, event, semaphore, results, errors) for kind, event in events])
+    if args.update_queue == "local":
+        # Latencies are then the acknowledgements, the wall time includes draining the queue
+        await app.get_update_queue().join()
+        await app.get_update_queue().close()
+    wall_seconds = time.perf_counter() - started
+    await bot_application.shutdown()
+    if app.openai_aiohttp_session is not None:
+        await app.openai_aiohttp_session.close()
+    return results, wall_seconds, init_ms, telegram.calls
+
+
+def summarize(args, results, wall_seconds, init_ms, telegram_calls, openai_calls, memory, errors):
+    kinds = sorted({result["kind"] for result in results})
+    per_kind = {}
+    for kind in ["all"] + kinds:
+        selected = [result for result in results if kind == "all" or result["kind"] == kind]
+        per_kind[kind] = {
+            "latency_ms": percentiles([result["latency_ms"] for result in selected]),
+            "storage_reads_per_update": sum(result["reads"] for result in selected) / len(selected),
+            "storage_writes_per_update": sum(result["writes"] for result in selected) / len(selected),
+            "dynamodb_requests_per_update": sum(result["dynamodb_requests"] for result in selected) / len(selected),
+            "failed": sum(result["failed"] for result in selected),
+        }
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "verbose")},
+        "python": sys.version.split()[0],
+        "updates": len(results),
+        "wall_seconds": wall_seconds,
+        "updates_per_second": len(results) / wall_seconds if wall_seconds else None,
+        "application_init_ms": init_ms,
+        "by_kind": per_kind,
+        "telegram_calls": telegram_calls,
+        "openai_calls": openai_calls,
+        "memory": memory,
+        "errors": errors[:20],
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    app.STREAMING_REPLIES = args.streaming
+    app.UPDATE_QUEUE = args.update_queue
+    if not args.rate_limits:
+        app.USER_REQUESTS_PER_MINUTE = 0
+        app.MODEL_REQUESTS_PER_MINUTE = {}
+
+    if args.events:
+        events = list(recorded_events(args.events, args.updates))
+        user_ids = sorted({sender_id(json.loads(event["body"])) for _, event in events} - {None})
+    else:
+        synthetic = SyntheticEvents(args.users, first_user_id=100, mix=parse_mix(args.mix))
+        events = list(synthetic.generate(args.updates))
+        user_ids = [str(user_id) for user_id in synthetic.user_ids]
+
+    openai_fake = FakeOpenAI(latency=args.openai_latency, token_interval=args.openai_token_interval,
+                             completion_tokens=args.completion_tokens, transcription_latency=args.transcription_latency,
+                             image_latency=args.image_latency)
+    openai_fake.install()
+    errors = []
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    # Every run starts from an empty database of its own, so runs can be compared
+    sqlite_dir = tempfile.TemporaryDirectory(prefix="bench-") if args.storage == "sqlite" else None
+    if sqlite_dir:
+        storage_module.SQLITE_PATH = os.path.join(sqlite_dir.name, "bench.sqlite3")
+    try:
+        with contextlib.redirect_stdout(output):
+            setup_storage(args.storage, user_ids)
+            if args.trace_memory:
+                tracemalloc.start()
+            loop = app.get_event_loop()
+            results, wall_seconds, init_ms, telegram_calls = loop.run_until_complete(run(args, events, errors))
+    finally:
+        if sqlite_dir:
+            sqlite_dir.cleanup()
+    memory = {"max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    if args.trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory.update({"traced_current_bytes": current, "traced_peak_bytes": peak,
+                       "retained_bytes_per_update": current / len(results) if results else 0})
+    openai_fake.uninstall()
+
+    summary = summarize(args, results, wall_seconds, init_ms, telegram_calls, openai_fake.calls, memory, errors)
+    with open(args.output, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    print_summary(summary, args.output)
+    return summary
+
+
+def print_summary(summary, output):
+    print("%d updates in %.2f s, %.1f updates/s" % (summary["updates"], summary["wall_seconds"], summary["updates_per_second"]))
+    for kind, stats in summary["by_kind"].items():
+        latency = stats["latency_ms"]
+        print("  %-8s p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  reads %.2f  writes %.2f  failed %d" % (
+            kind, latency["p50"], latency["p95"], latency["p99"], stats["storage_reads_per_update"],
+            stats["storage_writes_per_update"], stats["failed"]))
+    if "traced_peak_bytes" in summary["memory"]:
+        print("  traced memory peak %.1f MiB" % (summary["memory"]["traced_peak_bytes"] / 1024 / 1024))
+    print("Results written to " + output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Per-update timings and counters, written as one CloudWatch Embedded Metric Format record per update.
+
+The record of the update being processed lives in a context variable, so the phases timed in handlers,
+in asyncio.gather children and in run_io threads all land in it. Lambda ships stdout to CloudWatch Logs,
+which turns the EMF records into metrics without any extra API call.
+"""
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "gpt-telegram-bot")
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Counters reported as metrics, anything else set on a record is only a property of the log line
+COUNTERS = ["prompt_tokens", "completion_tokens", "dynamodb_reads", "dynamodb_writes", "errors",
+            "response_cache_hits", "response_cache_misses", "openai_retries", "openai_failovers",
+            "openai_hedged_requests"]
+
+current_update = contextvars.ContextVar("current_update", default=None)
+
+
+class UpdateMetrics:
+    """Durations by phase in milliseconds, counters and properties of one update."""
+
+    def __init__(self, cold_start):
+        self.started_at = time.perf_counter()
+        self.cold_start = cold_start
+        self.update_type = "unknown"
+        self.phases = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.properties = {}
+        self.lock = threading.Lock()
+
+    def add_phase(self, name, milliseconds):
+        # A phase entered several times (e.g. two OpenAI calls) adds up
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + milliseconds
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_emf(self):
+        phases = {name + "_ms": round(duration, 3) for name, duration in self.phases.items()}
+        phases["total_ms"] = round((time.perf_counter() - self.started_at) * 1000, 3)
+        metrics = [{"Name": name, "Unit": "Milliseconds"} for name in phases]
+        metrics += [{"Name": name, "Unit": "Count"} for name in self.counters]
+        metrics.append({"Name": "cold_start", "Unit": "Count"})
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE, "Dimensions": [["update_type"]],
+                                       "Metrics": metrics}]
+            },
+            "update_type": self.update_type,
+            "cold_start": int(self.cold_start),
+            **phases,
+            **self.counters,
+            **self.properties
+        }
+
+
+def start_update(cold_start):
+    record = UpdateMetrics(cold_start)
+    current_update.set(record)
+    return record
+
+
+def emit(record):
+    if METRICS_ENABLED:
+        print(json.dumps(record.to_emf(), default=str))
+
+
+def increment(name, value=1):
+    record = current_update.get()
+    if record is not None:
+        record.increment(name, value)
+
+
+def add_phase(name, milliseconds):
+    record = current_update.get()
+    if record is not None:
+        record.add_phase(name, milliseconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the block as the phase name of the current update, a no-op outside of an update."""
+    record = current_update.get()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        if record is not None:
+            record.add_phase(name, (time.perf_counter() - started_at) * 1000)
+
+
+def timed(name):
+    """Decorator timing every call of a function or coroutine function as the phase name."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with phase(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,223 @@
+"""Timeouts, retries, hedging and a circuit breaker around the OpenAI calls.
+
+A call is retried on rate limits, 5xx answers, connection errors and timeouts with jittered exponential
+backoff, waiting at least what a Retry-After header asks for. Every model has a circuit breaker: after
+CIRCUIT_FAILURE_THRESHOLD failures in a row the model is not called for CIRCUIT_RESET_SECONDS, and
+calls that have a fallback model go to it straight away. The breakers are per container.
+
+A Lambda invocation sets a deadline (see set_deadline): attempts are cut short to end by it, and no retry
+or failover is started without OPENAI_MIN_ATTEMPT_SECONDS left.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+
+from chalicelib import metrics
+
+logger = logging.getLogger(__name__)
+
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", "3"))
+OPENAI_BACKOFF_BASE_SECONDS = 0.5
+OPENAI_BACKOFF_MAX_SECONDS = 8
+# A call still running after that many seconds gets a second identical request, the first answer wins.
+# Both requests are billed by OpenAI, 0 disables hedging
+OPENAI_HEDGE_AFTER_SECONDS = float(os.getenv("OPENAI_HEDGE_AFTER_SECONDS", "0"))
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 30
+# An attempt is not started with less time than that left before the deadline
+OPENAI_MIN_ATTEMPT_SECONDS = 5
+
+# time.monotonic() by which the OpenAI calls of the current context must be done, None when there is no deadline
+deadline = contextvars.ContextVar("openai_deadline", default=None)
+
+
+class CircuitOpenError(Exception):
+    """The model failed too often lately and is not called until its circuit breaker resets."""
+
+
+class DeadlineExceededError(Exception):
+    """Too little time is left before the deadline to start an OpenAI request."""
+
+
+class CircuitBreaker:
+    """Opens after threshold consecutive failures, lets one trial call through reset_seconds later."""
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_seconds:
+                # Half open: the next failure opens it again for a whole period
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_breaker(model_name):
+    with breakers_lock:
+        if model_name not in breakers:
+            breakers[model_name] = CircuitBreaker()
+        return breakers[model_name]
+
+
+def set_deadline(seconds):
+    """Give the OpenAI calls of the current context seconds from now, returns the token for reset_deadline."""
+    return deadline.set(time.monotonic() + seconds)
+
+
+def reset_deadline(token):
+    deadline.reset(token)
+
+
+def get_time_left():
+    """Seconds left before the deadline, None when there is no deadline."""
+    value = deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+def has_time_for_attempt(wait=0):
+    """Whether an attempt starting wait seconds from now gets at least OPENAI_MIN_ATTEMPT_SECONDS."""
+    time_left = get_time_left()
+    return time_left is None or time_left - wait >= OPENAI_MIN_ATTEMPT_SECONDS
+
+
+def cap_to_deadline(timeout):
+    """timeout, shortened to end by the deadline."""
+    time_left = get_time_left()
+    return timeout if time_left is None else max(0, min(timeout, time_left))
+
+
+def is_retryable(error):
+    import openai.error
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if isinstance(error, openai.error.RateLimitError):
+        # Out of credits is not going to get better with a retry
+        return error.code != "insufficient_quota"
+    if isinstance(error, (openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain,
+                          openai.error.ServiceUnavailableError)):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status is None or error.http_status >= 500)
+
+
+def get_retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(attempt, error):
+    backoff = min(OPENAI_BACKOFF_MAX_SECONDS, OPENAI_BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1)
+    retry_after = get_retry_after(error)
+    return max(backoff, retry_after) if retry_after is not None else backoff
+
+
+async def call_hedged(call, timeout, hedge_after):
+    """Run call with a timeout, starting a second one if the first takes longer than hedge_after seconds."""
+    first = asyncio.ensure_future(asyncio.wait_for(call(), timeout))
+    if not hedge_after:
+        return await first
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result()
+    metrics.increment("openai_hedged_requests")
+    pending = {first, asyncio.ensure_future(asyncio.wait_for(call(), cap_to_deadline(timeout)))}
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return task.result()
+            error = task.exception()
+    raise error
+
+
+async def call_with_retries(call, model_name, timeout, hedge_after=0, max_attempts=OPENAI_MAX_ATTEMPTS):
+    """Call with the timeout, retrying the errors worth retrying, behind the circuit breaker of model_name.
+
+    Attempts end by the deadline, raises DeadlineExceededError when there is no time left for the first one."""
+    breaker = get_breaker(model_name)
+    for attempt in range(max_attempts):
+        if not has_time_for_attempt():
+            raise DeadlineExceededError("No time left to call " + model_name)
+        if not breaker.allow():
+            raise CircuitOpenError(model_name + " is failing, not calling it for now")
+        try:
+            result = await call_hedged(call, cap_to_deadline(timeout), hedge_after)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            breaker.record_failure()
+            metrics.increment("openai_retries")
+            if attempt == max_attempts - 1:
+                raise
+            backoff = get_backoff(attempt, e)
+            if not has_time_for_attempt(backoff):
+                logger.warning("OpenAI call to %s failed (%r), no time left to retry it", model_name, e)
+                metrics.increment("openai_deadline_exceeded")
+                raise
+            logger.warning("OpenAI call to %s failed (%r), retrying in %.1f s", model_name, e, backoff)
+            await asyncio.sleep(backoff)
+        else:
+            breaker.record_success()
+            return result
+
+
+async def call_with_failover(call, model_name, timeout, fallback_model=None, fallback_timeout=None, hedge_after=0):
+    """call(model_name) with retries, then with fallback_model if model_name keeps failing or its circuit is open.
+
+    Returns (result, name of the model that answered)."""
+    try:
+        return await call_with_retries(lambda: call(model_name), model_name, timeout, hedge_after), model_name
+    except Exception as e:
+        if fallback_model is None or not (isinstance(e, CircuitOpenError) or is_retryable(e)):
+            raise
+        if not has_time_for_attempt():
+            logger.warning("%s failed (%r), no time left to fail over to %s", model_name, e, fallback_model)
+            metrics.increment("openai_deadline_exceeded")
+            raise
+        logger.warning("Failing over from %s to %s: %r", model_name, fallback_model, e)
+        metrics.increment("openai_failovers")
+    result = await call_with_retries(lambda: call(fallback_model), fallback_model, fallback_timeout or timeout, hedge_after)
+    return result, fallback_model
+
+
+async def iterate_with_timeout(stream, timeout):
+    """Yield the chunks of an async stream, failing when the next chunk takes more than timeout seconds
+    or doesn't come by the deadline."""
+    iterator = stream.__aiter__()
+    while True:
+        try:
+            yield await asyncio.wait_for(iterator.__anext__(), cap_to_deadline(timeout))
+        except StopAsyncIteration:
+            return
@@ -0,0 +1,186 @@
+import datetime
+import os
+import threading
+import time
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "dynamodb")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "gpt-telegram-bot.sqlite3")
+
+SPENDING_ALL_TIME_BUCKET = 0
+# Spending rows are keyed by user and timestamp in seconds with millisecond precision. A row whose timestamp
+# is taken moves a millisecond past the last row of the user, so spendings of the same moment are all kept
+SPENDING_TIMESTAMP_STEP = 0.001
+SPENDING_WRITE_ATTEMPTS = 5
+
+storage = None
+storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Return the storage backend selected by the STORAGE_BACKEND environment variable."""
+    global storage
+    with storage_lock:
+        if storage is None:
+            storage = create_storage(STORAGE_BACKEND)
+        return storage
+
+
+def create_storage(backend):
+    if backend == "dynamodb":
+        from chalicelib.storage.dynamodb import DynamoDBStorage
+        return DynamoDBStorage()
+    if backend == "sqlite":
+        from chalicelib.storage.sqlite import SQLiteStorage
+        return SQLiteStorage(SQLITE_PATH)
+    if backend == "memory":
+        from chalicelib.storage.memory import MemoryStorage
+        return MemoryStorage()
+    raise Exception("Unknown storage backend: " + backend)
+
+
+def get_month_bucket(timestamp):
+    """Running spending totals are kept per month under YYYYMM buckets."""
+    return int(datetime.datetime.fromtimestamp(timestamp).strftime("%Y%m"))
+
+
+def get_spending_timestamp():
+    return round(time.time(), 3)
+
+
+def next_spending_timestamp(timestamp):
+    return round(float(timestamp) + SPENDING_TIMESTAMP_STEP, 3)
+
+
+class Storage:
+    """Persistence of the bot: messages, allowed users, per-user config and spendings.
+
+    Items are plain dicts shaped like the DynamoDB items, user ids are strings and message ids integers.
+    Every method is blocking, the bot calls them through its IO thread pool.
+    """
+
+    # Users
+    def has_user(self, user_id, user_type):
+        raise NotImplementedError
+
+    def add_user(self, user_id, user_type):
+        raise NotImplementedError
+
+    def delete_user(self, user_id, user_type):
+        raise NotImplementedError
+
+    def list_users(self, user_type):
+        """Return the ids of the users of user_type, sorted."""
+        raise NotImplementedError
+
+    # Messages
+    def put_message(self, user_id, message_id, role, text, tokens_used, tokens=None, expires_at=None):
+        """Store a message, tokens being the token count of its text (None for unknown).
+
+        A message with expires_at (unix time) is no longer returned after it and deleted eventually."""
+        raise NotImplementedError
+
+    def get_message(self, user_id, message_id):
+        """Return the message item or None."""
+        raise NotImplementedError
+
+    def query_messages(self, user_id, first_id=None, last_id=None, newest_first=False, page_size=None, fields=None,
+                       consistent=False):
+        """Iterate over the messages with first_id <= message_id <= last_id, fetched page_size at a time.
+
+        With fields only those attributes are fetched. consistent reads see every write done before them,
+        at twice the read cost on DynamoDB.
+        """
+        raise NotImplementedError
+
+    def delete_messages(self, user_id, after_id, last_id=None):
+        """Delete every message of the user with after_id < message_id <= last_id, last_id None for no bound."""
+        raise NotImplementedError
+
+    def clear_history(self, user_id, up_to_id):
+        """Record in the config of the user that the history up to up_to_id was cleared.
+
+        Only ever moves forward, and does nothing for users without config."""
+        raise NotImplementedError
+
+    # Config
+    def get_config(self, user_id):
+        """Return the config item or None."""
+        raise NotImplementedError
+
+    def put_config(self, user_id, values):
+        raise NotImplementedError
+
+    def update_config(self, user_id, values):
+        raise NotImplementedError
+
+    def delete_config(self, user_id):
+        raise NotImplementedError
+
+    def put_seed_version(self, key, version):
+        """Store {"seed_version": version} under the key unless an equal or newer version is stored."""
+        raise NotImplementedError
+
+    # Updates
+    def claim_update(self, update_id, ttl):
+        """Mark the Telegram update as processed for ttl seconds, False when it already was (a re-delivery)."""
+        raise NotImplementedError
+
+    # Turns and rate limits
+    def acquire_turn(self, user_id, owner, ttl):
+        """Take the processing turn of the user for ttl seconds, unless another owner holds an unexpired one.
+
+        Returns (acquired, answered_up_to), answered_up_to is None until a turn of the user was released.
+        """
+        raise NotImplementedError
+
+    def renew_turn(self, user_id, owner, ttl):
+        """Extend the turn held by owner to ttl seconds from now, False when owner no longer holds it."""
+        raise NotImplementedError
+
+    def release_turn(self, user_id, owner, answered_up_to):
+        """Give back the turn taken by owner, storing the id of the last answered user message."""
+        raise NotImplementedError
+
+    def take_token(self, key, capacity, refill_per_second):
+        """Take one token from the token bucket key, which refills at refill_per_second up to capacity.
+
+        Returns 0 when a token was taken, otherwise the seconds until one is available.
+        """
+        raise NotImplementedError
+
+    # Response cache
+    def get_cached_response(self, key):
+        """Return the cached response item or None when it is missing or expired."""
+        raise NotImplementedError
+
+    def put_cached_response(self, key, item, ttl):
+        """Cache the response item under key for ttl seconds, the backend may evict it earlier."""
+        raise NotImplementedError
+
+    # Spendings
+    def put_spending(self, item):
+        """Store the spending row, never over another one: when its timestamp is taken it moves a millisecond
+        past the latest row of the user. Returns the timestamp the row was stored under."""
+        raise NotImplementedError
+
+    def add_to_spending_totals(self, user_id, price, month_bucket):
+        """Add price to the all-time and month_bucket totals of the user."""
+        raise NotImplementedError
+
+    def get_spending_totals(self, user_id):
+        """Return the totals of the user by bucket, SPENDING_ALL_TIME_BUCKET or YYYYMM."""
+        raise NotImplementedError
+
+    def get_all_spending_totals(self):
+        """Return the all-time totals by user id."""
+        raise NotImplementedError
+
+    def rebuild_spending_totals(self):
+        """Recompute every total from the spending rows, returns the all-time totals by user id."""
+        raise NotImplementedError
+
+    def put_exchange(self, user_id, messages, spending):
+        """Write the messages ({"message_id", "role", "text", "tokens_used", "tokens", "expires_at"}), the
+        spending row and the totals of the user it adds to as one all or nothing write. The all users totals
+        may be updated right after it."""
+        raise NotImplementedError
@@ -0,0 +1,573 @@
+import os
+import random
+import threading
+import time
+import zlib
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
+from chalicelib import metrics
+from chalicelib.storage import (Storage, SPENDING_ALL_TIME_BUCKET, SPENDING_WRITE_ATTEMPTS, get_month_bucket,
+                                next_spending_timestamp)
+
+DYNAMODB_TABLE = os.getenv("DYNAMODB_TABLE_NAME")
+DYNAMODB_USER_TABLE = os.getenv("DYNAMODB_USERS_TABLE_NAME")
+DYNAMODB_CONFIG_TABLE = os.getenv("DYNAMODB_CONFIG_TABLE_NAME")
+DYNAMODB_SPENDINGS_TABLE = os.getenv("DYNAMODB_SPENDINGS_TABLE_NAME")
+# Message texts of at least that many bytes are stored zlib compressed in text_z, 0 stores them as they are
+COMPRESS_TEXT_MIN_BYTES = int(os.getenv("DYNAMODB_COMPRESS_TEXT_MIN_BYTES", "0"))
+
+# Running totals live in the spendings table next to the spending rows: per user under the
+# SPENDING_ALL_TIME_BUCKET and YYYYMM sort keys, and for all users as one attribute per user on
+# the SPENDING_TOTALS_KEY item. Real spending rows use unix timestamps, far above any bucket.
+SPENDING_TOTALS_KEY = "__totals__"
+SPENDING_BUCKETS_LIMIT = 1000000
+SPENDING_REBUILD_SEGMENTS = 4
+# Writes to an item a transaction is writing fail with TransactionConflict, which botocore doesn't retry
+TRANSACTION_CONFLICT_ATTEMPTS = 5
+TRANSACTION_CONFLICT_BACKOFF_SECONDS = 0.05
+# Processed Telegram updates are marked in the config table under this prefix, expiring through the
+# table TTL on expires_at
+PROCESSED_UPDATE_PREFIX = "__update__"
+# Turn locks of the users and rate limit buckets live in the config table as well
+TURN_PREFIX = "__turn__"
+RATE_LIMIT_PREFIX = "__rate__"
+RATE_LIMIT_ATTEMPTS = 5
+# Cached responses too, expiring through the table TTL
+RESPONSE_CACHE_PREFIX = "__response__"
+# The ids of the users of each type are kept as a string set on a roster item of the config table, so
+# listing them is one read instead of a scan of the users table. Rosters written before the users table
+# was last scanned lack the complete flag and are filled by one paginated scan
+ROSTER_PREFIX = "__roster__"
+READ_OPERATIONS = {"GetItem", "BatchGetItem", "Query", "Scan", "TransactGetItems"}
+WRITE_OPERATIONS = {"PutItem", "UpdateItem", "DeleteItem", "BatchWriteItem", "TransactWriteItems"}
+
+# Connect to DynamoDB on first use. The Table objects are only used to issue requests, which go through
+# the thread-safe low-level client, so they are shared by the IO threads
+dynamodb = None
+dynamodb_lock = threading.Lock()
+
+
+def get_dynamodb():
+    global dynamodb
+    with dynamodb_lock:
+        if dynamodb is None:
+            import boto3
+            dynamodb = boto3.resource("dynamodb")
+            dynamodb.meta.client.meta.events.register("before-call.dynamodb", count_request)
+        return dynamodb
+
+
+def count_request(model, **kwargs):
+    """Count every DynamoDB request, each page of a query included, in the metrics of the current update."""
+    if model.name in READ_OPERATIONS:
+        metrics.increment("dynamodb_reads")
+    elif model.name in WRITE_OPERATIONS:
+        metrics.increment("dynamodb_writes")
+
+
+class LazyTable:
+    """DynamoDB Table created on first attribute access."""
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self._table = None
+
+    def __getattr__(self, name):
+        if self._table is None:
+            self._table = get_dynamodb().Table(self.table_name)
+        return getattr(self._table, name)
+
+
+def query_all(table, **query_args):
+    while True:
+        response = table.query(**query_args)
+        yield from response["Items"]
+        if "LastEvaluatedKey" not in response:
+            return
+        query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def projection(fields):
+    names = {"#f" + str(i): field for i, field in enumerate(fields)}
+    return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+
+def message_item(user_id, message_id, role, text, tokens_used, tokens=None, expires_at=None):
+    item = {
+        "user_id": str(user_id),
+        "message_id": int(message_id),
+        "role": role,
+        "tokens_used": tokens_used
+    }
+    encoded = text.encode()
+    if COMPRESS_TEXT_MIN_BYTES and len(encoded) >= COMPRESS_TEXT_MIN_BYTES:
+        # Write capacity is billed by the KB, long answers compress to a fraction
+        item["text_z"] = zlib.compress(encoded)
+    else:
+        item["text"] = text
+    if tokens is not None:
+        item["tokens"] = int(tokens)
+    if expires_at is not None:
+        item["expires_at"] = int(expires_at)
+    return item
+
+
+def get_conflict_backoff(attempt):
+    return TRANSACTION_CONFLICT_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1)
+
+
+def spending_item(item, timestamp):
+    # DynamoDB numbers are Decimals, floats are refused
+    return dict(item, timestamp=Decimal(str(timestamp)))
+
+
+def decode_message(item):
+    if item is not None and "text_z" in item:
+        item["text"] = zlib.decompress(item.pop("text_z").value).decode()
+    return item
+
+
+class DynamoDBStorage(Storage):
+    def __init__(self):
+        self.messages_table = LazyTable(DYNAMODB_TABLE)
+        self.users_table = LazyTable(DYNAMODB_USER_TABLE)
+        self.config_table = LazyTable(DYNAMODB_CONFIG_TABLE)
+        self.spendings_table = LazyTable(DYNAMODB_SPENDINGS_TABLE)
+
+    # Users
+    def has_user(self, user_id, user_type):
+        response = self.users_table.get_item(
+            Key={"user_id": str(user_id),
+                 "user_type": str(user_type)
+                 }
+        )
+        return "Item" in response
+
+    def add_user(self, user_id, user_type):
+        self.update_users(user_id, user_type, add=True)
+
+    def delete_user(self, user_id, user_type):
+        self.update_users(user_id, user_type, add=False)
+
+    def update_users(self, user_id, user_type, add):
+        """Put or delete the user item and its id in the roster in one transaction."""
+        from boto3.dynamodb.types import TypeSerializer
+        serializer = TypeSerializer()
+        key = {"user_id": serializer.serialize(str(user_id)), "user_type": serializer.serialize(str(user_type))}
+        user_item = {"Put": {"TableName": self.users_table.name, "Item": key}} if add else \
+            {"Delete": {"TableName": self.users_table.name, "Key": key}}
+        roster_update = {"Update": {
+            "TableName": self.config_table.name,
+            "Key": {"user_id": serializer.serialize(ROSTER_PREFIX + str(user_type))},
+            "UpdateExpression": ("ADD" if add else "DELETE") + " user_ids :ids",
+            "ExpressionAttributeValues": {":ids": serializer.serialize({str(user_id)})}
+        }}
+        self.users_table.meta.client.transact_write_items(TransactItems=[user_item, roster_update])
+
+    def list_users(self, user_type):
+        roster = self.config_table.get_item(Key={"user_id": ROSTER_PREFIX + str(user_type)}).get("Item") or {}
+        if roster.get("complete"):
+            return sorted(roster.get("user_ids", set()))
+        user_ids = set(roster.get("user_ids", set())) | self._scan_users(user_type)
+        update = "SET complete = :t"
+        values = {":t": True}
+        if user_ids:
+            update = "ADD user_ids :ids " + update
+            values[":ids"] = user_ids
+        self.config_table.update_item(Key={"user_id": ROSTER_PREFIX + str(user_type)},
+                                      UpdateExpression=update, ExpressionAttributeValues=values)
+        return sorted(user_ids)
+
+    def _scan_users(self, user_type):
+        from boto3.dynamodb.conditions import Attr
+        scan_args = {"FilterExpression": Attr("user_type").eq(str(user_type)), "ProjectionExpression": "user_id"}
+        user_ids = set()
+        while True:
+            response = self.users_table.scan(**scan_args)
+            user_ids.update(item["user_id"] for item in response["Items"])
+            if "LastEvaluatedKey" not in response:
+                return user_ids
+            scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    # Messages
+    def put_message(self, user_id, message_id, role, text, tokens_used, tokens=None, expires_at=None):
+        self.messages_table.put_item(Item=message_item(user_id, message_id, role, text, tokens_used, tokens, expires_at))
+
+    def get_message(self, user_id, message_id):
+        response = self.messages_table.get_item(
+            Key={
+                "user_id": str(user_id),
+                "message_id": int(message_id)
+            }
+        )
+        return decode_message(response.get("Item"))
+
+    def query_messages(self, user_id, first_id=None, last_id=None, newest_first=False, page_size=None, fields=None,
+                       consistent=False):
+        from boto3.dynamodb.conditions import Attr, Key
+        condition = Key("user_id").eq(str(user_id))
+        if first_id is not None and last_id is not None:
+            condition &= Key("message_id").between(int(first_id), int(last_id))
+        elif first_id is not None:
+            condition &= Key("message_id").gte(int(first_id))
+        elif last_id is not None:
+            condition &= Key("message_id").lte(int(last_id))
+        query_args = {
+            "KeyConditionExpression": condition,
+            # The table TTL deletes expired messages up to a few days late
+            "FilterExpression": Attr("expires_at").not_exists() | Attr("expires_at").gte(int(time.time())),
+            "ScanIndexForward": not newest_first,
+            "ConsistentRead": consistent
+        }
+        if page_size:
+            query_args["Limit"] = page_size
+        if fields:
+            query_args.update(projection(fields + ["text_z"] if "text" in fields else fields))
+        return map(decode_message, query_all(self.messages_table, **query_args))
+
+    def delete_messages(self, user_id, after_id, last_id=None):
+        messages = self.query_messages(user_id, first_id=int(after_id) + 1, last_id=last_id, fields=["message_id"])
+        with self.messages_table.batch_writer() as batch:
+            for msg in messages:
+                batch.delete_item(
+                    Key={
+                        "user_id": str(user_id),
+                        "message_id": int(msg["message_id"])
+                    }
+                )
+
+    def clear_history(self, user_id, up_to_id):
+        try:
+            self.config_table.update_item(
+                Key={"user_id": str(user_id)},
+                UpdateExpression="SET cleared_up_to = :m",
+                ConditionExpression="attribute_exists(user_id) AND (attribute_not_exists(cleared_up_to) OR cleared_up_to < :m)",
+                ExpressionAttributeValues={":m": int(up_to_id)}
+            )
+        except self.config_table.meta.client.exceptions.ConditionalCheckFailedException:
+            # No config, or a later /clear was recorded already
+            pass
+
+    # Config
+    def get_config(self, user_id):
+        response = self.config_table.get_item(
+            Key={
+                "user_id": str(user_id)
+            }
+        )
+        return response.get("Item")
+
+    def put_config(self, user_id, values):
+        self.config_table.put_item(Item={"user_id": str(user_id), **values})
+
+    def update_config(self, user_id, values):
+        names = {"#f" + str(i): field for i, field in enumerate(values)}
+        self.config_table.update_item(
+            Key={
+                "user_id": str(user_id)
+            },
+            UpdateExpression="set " + ", ".join(name + "=:v" + name[2:] for name in names),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={":v" + name[2:]: values[field] for name, field in names.items()}
+        )
+
+    def delete_config(self, user_id):
+        self.config_table.delete_item(
+            Key={
+                "user_id": str(user_id)
+            }
+        )
+
+    def put_seed_version(self, key, version):
+        try:
+            self.config_table.put_item(
+                Item={
+                    "user_id": key,
+                    "seed_version": version
+                },
+                ConditionExpression="attribute_not_exists(user_id) OR seed_version < :v",
+                ExpressionAttributeValues={":v": version}
+            )
+        except self.config_table.meta.client.exceptions.ConditionalCheckFailedException:
+            # A concurrent container already stored the same or a newer seed version
+            pass
+
+    # Updates
+    def claim_update(self, update_id, ttl):
+        now = int(time.time())
+        try:
+            self.config_table.put_item(
+                Item={
+                    "user_id": PROCESSED_UPDATE_PREFIX + str(update_id),
+                    "expires_at": now + ttl
+                },
+                # The table TTL deletes expired items lazily, so they are checked here as well
+                ConditionExpression="attribute_not_exists(user_id) OR expires_at < :now",
+                ExpressionAttributeValues={":now": now}
+            )
+        except self.config_table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    # Turns and rate limits
+    def acquire_turn(self, user_id, owner, ttl):
+        now = int(time.time())
+        try:
+            response = self.config_table.update_item(
+                Key={"user_id": TURN_PREFIX + str(user_id)},
+                UpdateExpression="SET lock_owner = :o, lock_expires_at = :e",
+                ConditionExpression="attribute_not_exists(lock_owner) OR lock_expires_at < :now OR lock_owner = :o",
+                ExpressionAttributeValues={":o": owner, ":e": now + ttl, ":now": now},
+                ReturnValues="ALL_NEW"
+            )
+        except self.config_table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False, None
+        answered_up_to = response["Attributes"].get("answered_up_to")
+        return True, None if answered_up_to is None else int(answered_up_to)
+
+    def renew_turn(self, user_id, owner, ttl):
+        try:
+            self.config_table.update_item(
+                Key={"user_id": TURN_PREFIX + str(user_id)},
+                UpdateExpression="SET lock_expires_at = :e",
+                ConditionExpression="lock_owner = :o",
+                ExpressionAttributeValues={":o": owner, ":e": int(time.time()) + ttl}
+            )
+            return True
+        except self.config_table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def release_turn(self, user_id, owner, answered_up_to):
+        update = "REMOVE lock_owner, lock_expires_at"
+        values = {":o": owner}
+        if answered_up_to is not None:
+            update = "SET answered_up_to = :a " + update
+            values[":a"] = int(answered_up_to)
+        try:
+            self.config_table.update_item(
+                Key={"user_id": TURN_PREFIX + str(user_id)},
+                UpdateExpression=update,
+                ConditionExpression="lock_owner = :o",
+                ExpressionAttributeValues=values
+            )
+        except self.config_table.meta.client.exceptions.ConditionalCheckFailedException:
+            # The turn expired and was taken over, its new owner goes on from the stored position
+            pass
+
+    def take_token(self, key, capacity, refill_per_second):
+        # Optimistic concurrency: the bucket is written only if nobody else updated it since it was read
+        for _ in range(RATE_LIMIT_ATTEMPTS):
+            item = self.config_table.get_item(Key={"user_id": RATE_LIMIT_PREFIX + key}, ConsistentRead=True).get("Item")
+            now = time.time()
+            if item is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, float(item["tokens"]) + (now - float(item["updated_at"])) * refill_per_second)
+            if tokens < 1:
+                return (1 - tokens) / refill_per_second
+            condition = {"ConditionExpression": "attribute_not_exists(user_id)"}
+            if item is not None:
+                condition = {"ConditionExpression": "updated_at = :u", "ExpressionAttributeValues": {":u": item["updated_at"]}}
+            try:
+                self.config_table.put_item(
+                    Item={
+                        "user_id": RATE_LIMIT_PREFIX + key,
+                        "tokens": Decimal(str(round(tokens - 1, 6))),
+                        "updated_at": Decimal(str(round(now, 6))),
+                        # A bucket left alone refills completely, it can as well be deleted by the table TTL
+                        "expires_at": int(now + capacity / refill_per_second) + 60
+                    },
+                    **condition
+                )
+                return 0
+            except self.config_table.meta.client.exceptions.ConditionalCheckFailedException:
+                continue
+        # Every lost write was another request taking a token from a bucket that still had some when read,
+        # contention alone doesn't mean the limit is reached
+        return 0
+
+    # Response cache
+    def get_cached_response(self, key):
+        response = self.config_table.get_item(Key={"user_id": RESPONSE_CACHE_PREFIX + key})
+        item = response.get("Item")
+        if item is None or item["expires_at"] < time.time():
+            return None
+        return item["response"]
+
+    def put_cached_response(self, key, item, ttl):
+        self.config_table.put_item(
+            Item={
+                "user_id": RESPONSE_CACHE_PREFIX + key,
+                "response": item,
+                "expires_at": int(time.time()) + ttl
+            }
+        )
+
+    # Spendings
+    def put_spending(self, item):
+        timestamp = item["timestamp"]
+        for _ in range(SPENDING_WRITE_ATTEMPTS):
+            try:
+                self.spendings_table.put_item(
+                    Item=spending_item(item, timestamp),
+                    ConditionExpression="attribute_not_exists(#ts)",
+                    ExpressionAttributeNames={"#ts": "timestamp"}
+                )
+                return timestamp
+            except self.spendings_table.meta.client.exceptions.ConditionalCheckFailedException:
+                timestamp = self._next_free_spending_timestamp(item["user_id"], timestamp)
+        raise Exception("No free spending timestamp for user " + item["user_id"])
+
+    def _next_free_spending_timestamp(self, user_id, timestamp):
+        from boto3.dynamodb.conditions import Key
+        latest = self.spendings_table.query(
+            KeyConditionExpression=Key("user_id").eq(str(user_id)) & Key("timestamp").gte(Decimal(str(timestamp))),
+            ScanIndexForward=False,
+            Limit=1,
+            ConsistentRead=True
+        )["Items"]
+        return next_spending_timestamp(latest[0]["timestamp"] if latest else timestamp)
+
+    def add_to_spending_totals(self, user_id, price, month_bucket):
+        client = self.spendings_table.meta.client
+        for bucket in (SPENDING_ALL_TIME_BUCKET, month_bucket):
+            # The buckets of the user are also written by the transactions of put_exchange
+            for attempt in range(TRANSACTION_CONFLICT_ATTEMPTS):
+                try:
+                    self.spendings_table.update_item(
+                        Key={"user_id": str(user_id), "timestamp": bucket},
+                        UpdateExpression="ADD price_in_10th_of_cents :p",
+                        ExpressionAttributeValues={":p": price}
+                    )
+                    break
+                except client.exceptions.TransactionConflictException:
+                    if attempt == TRANSACTION_CONFLICT_ATTEMPTS - 1:
+                        raise
+                    time.sleep(get_conflict_backoff(attempt))
+        self.sync_all_users_totals(user_id)
+
+    def sync_all_users_totals(self, user_id):
+        """Copy the all-time total of the user to the SPENDING_TOTALS_KEY item.
+
+        That item is shared by every user, so it is never written in a transaction, where concurrent spendings
+        would conflict on it. Totals only grow: the copy is skipped when a larger one is there already, which
+        makes it safe to repeat and to run concurrently.
+        """
+        response = self.spendings_table.get_item(
+            Key={"user_id": str(user_id), "timestamp": SPENDING_ALL_TIME_BUCKET},
+            ConsistentRead=True
+        )
+        total = response.get("Item", {}).get("price_in_10th_of_cents", 0)
+        try:
+            self.spendings_table.update_item(
+                Key={"user_id": SPENDING_TOTALS_KEY, "timestamp": SPENDING_ALL_TIME_BUCKET},
+                UpdateExpression="SET #u = :t",
+                ConditionExpression="attribute_not_exists(#u) OR #u < :t",
+                ExpressionAttributeNames={"#u": str(user_id)},
+                ExpressionAttributeValues={":t": total}
+            )
+        except self.spendings_table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def get_spending_totals(self, user_id):
+        from boto3.dynamodb.conditions import Key
+        return {int(item["timestamp"]): item["price_in_10th_of_cents"] for item in query_all(
+            self.spendings_table,
+            KeyConditionExpression=Key("user_id").eq(str(user_id)) &
+            Key("timestamp").lt(SPENDING_BUCKETS_LIMIT)
+        )}
+
+    def get_all_spending_totals(self):
+        response = self.spendings_table.get_item(
+            Key={"user_id": SPENDING_TOTALS_KEY, "timestamp": SPENDING_ALL_TIME_BUCKET}
+        )
+        totals = response.get("Item", {})
+        return {user_id: spendings for user_id, spendings in totals.items() if user_id not in ("user_id", "timestamp")}
+
+    def put_exchange(self, user_id, messages, spending):
+        from boto3.dynamodb.types import TypeSerializer
+        serializer = TypeSerializer()
+
+        def serialize(values):
+            return {name: serializer.serialize(value) for name, value in values.items()}
+
+        def add_price(key, attribute):
+            return {"Update": {
+                "TableName": self.spendings_table.name,
+                "Key": serialize(key),
+                "UpdateExpression": "ADD #p :p",
+                "ExpressionAttributeNames": {"#p": attribute},
+                "ExpressionAttributeValues": serialize({":p": spending["price_in_10th_of_cents"]})
+            }}
+
+        client = self.messages_table.meta.client
+        timestamp = spending["timestamp"]
+        for attempt in range(SPENDING_WRITE_ATTEMPTS):
+            items = [{"Put": {"TableName": self.messages_table.name, "Item": serialize(message_item(user_id, **message))}}
+                     for message in messages]
+            spending_index = len(items)
+            items.append({"Put": {
+                "TableName": self.spendings_table.name,
+                "Item": serialize(spending_item(spending, timestamp)),
+                "ConditionExpression": "attribute_not_exists(#ts)",
+                "ExpressionAttributeNames": {"#ts": "timestamp"}
+            }})
+            for bucket in (SPENDING_ALL_TIME_BUCKET, get_month_bucket(timestamp)):
+                items.append(add_price({"user_id": str(user_id), "timestamp": bucket}, "price_in_10th_of_cents"))
+            try:
+                client.transact_write_items(TransactItems=items)
+                break
+            except client.exceptions.TransactionCanceledException as e:
+                # Nothing was written, the transaction can be sent again
+                codes = [reason.get("Code") for reason in e.response.get("CancellationReasons", [])]
+                if len(codes) > spending_index and codes[spending_index] == "ConditionalCheckFailed":
+                    timestamp = self._next_free_spending_timestamp(user_id, timestamp)
+                elif "TransactionConflict" in codes:
+                    time.sleep(get_conflict_backoff(attempt))
+                else:
+                    raise
+        else:
+            raise Exception("Couldn't store the spending of user " + str(user_id))
+        # Only /spendings reads the all users totals, the next spending of the user or /rebuild_spendings
+        # repairs them if this fails
+        self.sync_all_users_totals(user_id)
+
+    def rebuild_spending_totals(self, total_segments=SPENDING_REBUILD_SEGMENTS):
+        """Parallel segmented scan of the spendings table, spendings added while it runs may be lost."""
+        with ThreadPoolExecutor(max_workers=total_segments) as pool:
+            segment_totals = list(pool.map(lambda segment: self._sum_spendings_segment(segment, total_segments),
+                                           range(total_segments)))
+        totals = {}
+        for segment in segment_totals:
+            for key, price in segment.items():
+                totals[key] = totals.get(key, 0) + price
+        all_users = {}
+        with self.spendings_table.batch_writer() as batch:
+            for (user_id, bucket), price in totals.items():
+                batch.put_item(Item={"user_id": user_id, "timestamp": bucket, "price_in_10th_of_cents": price})
+                if bucket == SPENDING_ALL_TIME_BUCKET:
+                    all_users[user_id] = price
+            batch.put_item(Item={"user_id": SPENDING_TOTALS_KEY, "timestamp": SPENDING_ALL_TIME_BUCKET, **all_users})
+        return all_users
+
+    def _sum_spendings_segment(self, segment, total_segments):
+        totals = {}
+        scan_args = {
+            "Segment": segment,
+            "TotalSegments": total_segments,
+            "ProjectionExpression": "user_id, #ts, price_in_10th_of_cents",
+            "ExpressionAttributeNames": {"#ts": "timestamp"}
+        }
+        while True:
+            response = self.spendings_table.scan(**scan_args)
+            for item in response["Items"]:
+                timestamp = int(item["timestamp"])
+                if item["user_id"] == SPENDING_TOTALS_KEY or timestamp < SPENDING_BUCKETS_LIMIT:
+                    continue
+                for bucket in (SPENDING_ALL_TIME_BUCKET, get_month_bucket(timestamp)):
+                    key = (item["user_id"], bucket)
+                    totals[key] = totals.get(key, 0) + item["price_in_10th_of_cents"]
+            if "LastEvaluatedKey" not in response:
+                return totals
+            scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
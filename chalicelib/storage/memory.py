@@ -0,0 +1,199 @@
+import copy
+import threading
+import time
+
+from chalicelib.storage import Storage, SPENDING_ALL_TIME_BUCKET, get_month_bucket, next_spending_timestamp
+
+
+class MemoryStorage(Storage):
+    """Process local storage for tests, benchmarks and throwaway runs, nothing is persisted."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = set()
+        self.messages = {}  # user_id -> {message_id: item}
+        self.config = {}
+        self.spendings = {}  # (user_id, timestamp) -> item
+        self.spending_totals = {}  # (user_id, bucket) -> price
+        self.processed_updates = {}  # update_id -> expires_at
+        self.turns = {}  # user_id -> {"owner", "expires_at", "answered_up_to"}
+        self.buckets = {}  # key -> (tokens, updated_at)
+        self.responses = {}  # key -> (expires_at, item)
+
+    # Users
+    def has_user(self, user_id, user_type):
+        return (str(user_id), str(user_type)) in self.users
+
+    def add_user(self, user_id, user_type):
+        with self.lock:
+            self.users.add((str(user_id), str(user_type)))
+
+    def delete_user(self, user_id, user_type):
+        with self.lock:
+            self.users.discard((str(user_id), str(user_type)))
+
+    def list_users(self, user_type):
+        with self.lock:
+            return sorted(user_id for user_id, stored_type in self.users if stored_type == str(user_type))
+
+    # Messages
+    def put_message(self, user_id, message_id, role, text, tokens_used, tokens=None, expires_at=None):
+        with self.lock:
+            self.messages.setdefault(str(user_id), {})[int(message_id)] = {
+                "user_id": str(user_id),
+                "message_id": int(message_id),
+                "role": role,
+                "text": text,
+                "tokens_used": copy.deepcopy(tokens_used),
+                "tokens": tokens,
+                "expires_at": expires_at
+            }
+
+    def get_message(self, user_id, message_id):
+        with self.lock:
+            message = self.messages.get(str(user_id), {}).get(int(message_id))
+            return copy.deepcopy(message)
+
+    def query_messages(self, user_id, first_id=None, last_id=None, newest_first=False, page_size=None, fields=None,
+                       consistent=False):
+        now = time.time()
+        with self.lock:
+            messages = [copy.deepcopy(message) for message_id, message in self.messages.get(str(user_id), {}).items()
+                        if (first_id is None or message_id >= int(first_id)) and (last_id is None or message_id <= int(last_id))
+                        and (message["expires_at"] is None or message["expires_at"] >= now)]
+        messages.sort(key=lambda message: message["message_id"], reverse=newest_first)
+        return iter(messages)
+
+    def delete_messages(self, user_id, after_id, last_id=None):
+        with self.lock:
+            user_messages = self.messages.get(str(user_id), {})
+            for message_id in [message_id for message_id in user_messages
+                               if message_id > int(after_id) and (last_id is None or message_id <= int(last_id))]:
+                del user_messages[message_id]
+
+    def clear_history(self, user_id, up_to_id):
+        with self.lock:
+            config = self.config.get(str(user_id))
+            if config is not None and config.get("cleared_up_to", 0) < int(up_to_id):
+                config["cleared_up_to"] = int(up_to_id)
+
+    # Config
+    def get_config(self, user_id):
+        with self.lock:
+            return copy.deepcopy(self.config.get(str(user_id)))
+
+    def put_config(self, user_id, values):
+        with self.lock:
+            self.config[str(user_id)] = {"user_id": str(user_id), **copy.deepcopy(values)}
+
+    def update_config(self, user_id, values):
+        with self.lock:
+            self.config.setdefault(str(user_id), {"user_id": str(user_id)}).update(copy.deepcopy(values))
+
+    def delete_config(self, user_id):
+        with self.lock:
+            self.config.pop(str(user_id), None)
+
+    def put_seed_version(self, key, version):
+        with self.lock:
+            config = self.config.get(key)
+            if config is None or config["seed_version"] < version:
+                self.put_config(key, {"seed_version": version})
+
+    # Updates
+    def claim_update(self, update_id, ttl):
+        now = time.time()
+        with self.lock:
+            if self.processed_updates.get(int(update_id), 0) >= now:
+                return False
+            self.processed_updates[int(update_id)] = now + ttl
+            return True
+
+    # Turns and rate limits
+    def acquire_turn(self, user_id, owner, ttl):
+        now = time.time()
+        with self.lock:
+            turn = self.turns.setdefault(str(user_id), {"owner": None, "expires_at": 0, "answered_up_to": None})
+            if turn["owner"] not in (None, owner) and turn["expires_at"] >= now:
+                return False, None
+            turn.update(owner=owner, expires_at=now + ttl)
+            return True, turn["answered_up_to"]
+
+    def renew_turn(self, user_id, owner, ttl):
+        with self.lock:
+            turn = self.turns.get(str(user_id))
+            if turn is None or turn["owner"] != owner:
+                return False
+            turn["expires_at"] = time.time() + ttl
+            return True
+
+    def release_turn(self, user_id, owner, answered_up_to):
+        with self.lock:
+            turn = self.turns.get(str(user_id))
+            if turn is not None and turn["owner"] == owner:
+                turn["owner"] = None
+                if answered_up_to is not None:
+                    turn["answered_up_to"] = int(answered_up_to)
+
+    def take_token(self, key, capacity, refill_per_second):
+        now = time.time()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * refill_per_second)
+            if tokens < 1:
+                return (1 - tokens) / refill_per_second
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+
+    # Response cache
+    def get_cached_response(self, key):
+        with self.lock:
+            expires_at, item = self.responses.get(key, (0, None))
+            return copy.deepcopy(item) if expires_at >= time.time() else None
+
+    def put_cached_response(self, key, item, ttl):
+        with self.lock:
+            self.responses[key] = (time.time() + ttl, copy.deepcopy(item))
+
+    # Spendings
+    def put_spending(self, item):
+        with self.lock:
+            timestamp = item["timestamp"]
+            if (item["user_id"], timestamp) in self.spendings:
+                timestamp = next_spending_timestamp(max(stored_timestamp for user_id, stored_timestamp in self.spendings
+                                                        if user_id == item["user_id"]))
+            self.spendings[(item["user_id"], timestamp)] = dict(item, timestamp=timestamp)
+            return timestamp
+
+    def add_to_spending_totals(self, user_id, price, month_bucket):
+        with self.lock:
+            for bucket in (SPENDING_ALL_TIME_BUCKET, month_bucket):
+                key = (str(user_id), bucket)
+                self.spending_totals[key] = self.spending_totals.get(key, 0) + price
+
+    def get_spending_totals(self, user_id):
+        with self.lock:
+            return {bucket: price for (stored_user_id, bucket), price in self.spending_totals.items()
+                    if stored_user_id == str(user_id)}
+
+    def get_all_spending_totals(self):
+        with self.lock:
+            return {user_id: price for (user_id, bucket), price in self.spending_totals.items()
+                    if bucket == SPENDING_ALL_TIME_BUCKET}
+
+    def rebuild_spending_totals(self):
+        with self.lock:
+            self.spending_totals = {}
+            for (user_id, timestamp), item in self.spendings.items():
+                for bucket in (SPENDING_ALL_TIME_BUCKET, get_month_bucket(timestamp)):
+                    key = (user_id, bucket)
+                    self.spending_totals[key] = self.spending_totals.get(key, 0) + item["price_in_10th_of_cents"]
+            return self.get_all_spending_totals()
+
+    def put_exchange(self, user_id, messages, spending):
+        with self.lock:
+            for message in messages:
+                self.put_message(user_id, message["message_id"], message["role"], message["text"],
+                                 message["tokens_used"], message["tokens"], message.get("expires_at"))
+            timestamp = self.put_spending(spending)
+            self.add_to_spending_totals(user_id, spending["price_in_10th_of_cents"], get_month_bucket(timestamp))
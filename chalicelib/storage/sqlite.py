@@ -0,0 +1,315 @@
+import json
+import sqlite3
+import threading
+import time
+
+from chalicelib.storage import (Storage, SPENDING_ALL_TIME_BUCKET, SPENDING_WRITE_ATTEMPTS, get_month_bucket,
+                                next_spending_timestamp)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    user_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    text TEXT NOT NULL,
+    tokens_used TEXT NOT NULL,
+    tokens INTEGER,
+    expires_at INTEGER,
+    PRIMARY KEY (user_id, message_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT NOT NULL,
+    user_type TEXT NOT NULL,
+    PRIMARY KEY (user_id, user_type)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS users_by_type ON users (user_type, user_id);
+CREATE TABLE IF NOT EXISTS config (
+    user_id TEXT PRIMARY KEY,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_id INTEGER PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_updates_by_expiry ON processed_updates (expires_at);
+CREATE TABLE IF NOT EXISTS turns (
+    user_id TEXT PRIMARY KEY,
+    lock_owner TEXT,
+    lock_expires_at REAL,
+    answered_up_to INTEGER
+);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS response_cache (
+    key TEXT PRIMARY KEY,
+    item TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS response_cache_by_expiry ON response_cache (expires_at);
+CREATE TABLE IF NOT EXISTS spendings (
+    user_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    price_in_10th_of_cents INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (user_id, timestamp)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS spendings_by_timestamp ON spendings (timestamp);
+CREATE TABLE IF NOT EXISTS spending_totals (
+    user_id TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    price_in_10th_of_cents INTEGER NOT NULL,
+    PRIMARY KEY (user_id, bucket)
+) WITHOUT ROWID;
+"""
+RESPONSE_CACHE_MAX_ITEMS = 10000
+MESSAGE_COLUMNS = ["user_id", "message_id", "role", "text", "tokens_used", "tokens", "expires_at"]
+
+
+class SQLiteStorage(Storage):
+    """Single file storage for self-hosting and local runs.
+
+    Each thread gets its own connection, WAL mode lets readers run next to the single writer.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection().executescript(SCHEMA)
+        # Databases created before the token counts were cached on the messages, or before they could expire
+        columns = [row["name"] for row in self.execute("PRAGMA table_info(messages)")]
+        for column in ("tokens", "expires_at"):
+            if column not in columns:
+                self.execute("ALTER TABLE messages ADD COLUMN " + column + " INTEGER")
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def execute(self, sql, parameters=()):
+        return self.connection().execute(sql, parameters)
+
+    # Users
+    def has_user(self, user_id, user_type):
+        row = self.execute("SELECT 1 FROM users WHERE user_id = ? AND user_type = ?",
+                           (str(user_id), str(user_type))).fetchone()
+        return row is not None
+
+    def add_user(self, user_id, user_type):
+        self.execute("INSERT OR REPLACE INTO users (user_id, user_type) VALUES (?, ?)",
+                     (str(user_id), str(user_type)))
+
+    def delete_user(self, user_id, user_type):
+        self.execute("DELETE FROM users WHERE user_id = ? AND user_type = ?", (str(user_id), str(user_type)))
+
+    def list_users(self, user_type):
+        rows = self.execute("SELECT user_id FROM users WHERE user_type = ? ORDER BY user_id", (str(user_type),))
+        return [row["user_id"] for row in rows]
+
+    # Messages
+    def put_message(self, user_id, message_id, role, text, tokens_used, tokens=None, expires_at=None):
+        self.execute("INSERT OR REPLACE INTO messages (user_id, message_id, role, text, tokens_used, tokens, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (str(user_id), int(message_id), role, text, json.dumps(tokens_used), tokens, expires_at))
+
+    def get_message(self, user_id, message_id):
+        row = self.execute("SELECT * FROM messages WHERE user_id = ? AND message_id = ?",
+                           (str(user_id), int(message_id))).fetchone()
+        return message_from_row(row) if row else None
+
+    def query_messages(self, user_id, first_id=None, last_id=None, newest_first=False, page_size=None, fields=None,
+                       consistent=False):
+        columns = ", ".join(column for column in MESSAGE_COLUMNS if not fields or column in fields or column == "message_id")
+        sql = "SELECT " + columns + " FROM messages WHERE user_id = ? AND (expires_at IS NULL OR expires_at >= ?)"
+        parameters = [str(user_id), int(time.time())]
+        if first_id is not None:
+            sql += " AND message_id >= ?"
+            parameters.append(int(first_id))
+        if last_id is not None:
+            sql += " AND message_id <= ?"
+            parameters.append(int(last_id))
+        sql += " ORDER BY message_id " + ("DESC" if newest_first else "ASC")
+        # The rows are read lazily from the cursor, so page_size needs no explicit paging here
+        for row in self.execute(sql, parameters):
+            yield message_from_row(row)
+
+    def delete_messages(self, user_id, after_id, last_id=None):
+        if last_id is None:
+            self.execute("DELETE FROM messages WHERE user_id = ? AND message_id > ?", (str(user_id), int(after_id)))
+        else:
+            self.execute("DELETE FROM messages WHERE user_id = ? AND message_id > ? AND message_id <= ?",
+                         (str(user_id), int(after_id), int(last_id)))
+        # Expired messages are only skipped by the reads, they are deleted along with the user's cleared ones
+        self.execute("DELETE FROM messages WHERE user_id = ? AND expires_at < ?", (str(user_id), int(time.time())))
+
+    def clear_history(self, user_id, up_to_id):
+        with self.transaction():
+            config = self.get_config(user_id)
+            if config is not None and config.get("cleared_up_to", 0) < int(up_to_id):
+                config["cleared_up_to"] = int(up_to_id)
+                self.put_config(user_id, config)
+
+    # Config
+    def get_config(self, user_id):
+        row = self.execute("SELECT item FROM config WHERE user_id = ?", (str(user_id),)).fetchone()
+        return json.loads(row["item"]) if row else None
+
+    def put_config(self, user_id, values):
+        self.execute("INSERT OR REPLACE INTO config (user_id, item) VALUES (?, ?)",
+                     (str(user_id), json.dumps({"user_id": str(user_id), **values})))
+
+    def update_config(self, user_id, values):
+        with self.transaction():
+            config = self.get_config(user_id) or {"user_id": str(user_id)}
+            config.update(values)
+            self.put_config(user_id, config)
+
+    def delete_config(self, user_id):
+        self.execute("DELETE FROM config WHERE user_id = ?", (str(user_id),))
+
+    def put_seed_version(self, key, version):
+        with self.transaction():
+            config = self.get_config(key)
+            if config is None or config["seed_version"] < version:
+                self.put_config(key, {"seed_version": version})
+
+    # Updates
+    def claim_update(self, update_id, ttl):
+        now = time.time()
+        with self.transaction():
+            self.execute("DELETE FROM processed_updates WHERE expires_at < ?", (now,))
+            claimed = self.execute("INSERT OR IGNORE INTO processed_updates (update_id, expires_at) VALUES (?, ?)",
+                                   (int(update_id), now + ttl)).rowcount
+        return claimed == 1
+
+    # Turns and rate limits
+    def acquire_turn(self, user_id, owner, ttl):
+        now = time.time()
+        with self.transaction():
+            row = self.execute("SELECT lock_owner, lock_expires_at, answered_up_to FROM turns WHERE user_id = ?",
+                               (str(user_id),)).fetchone()
+            if row and row["lock_owner"] not in (None, owner) and row["lock_expires_at"] >= now:
+                return False, None
+            self.execute("INSERT INTO turns (user_id, lock_owner, lock_expires_at) VALUES (?, ?, ?) "
+                         "ON CONFLICT (user_id) DO UPDATE SET lock_owner = excluded.lock_owner, lock_expires_at = excluded.lock_expires_at",
+                         (str(user_id), owner, now + ttl))
+        return True, row["answered_up_to"] if row else None
+
+    def renew_turn(self, user_id, owner, ttl):
+        cursor = self.execute("UPDATE turns SET lock_expires_at = ? WHERE user_id = ? AND lock_owner = ?",
+                              (time.time() + ttl, str(user_id), owner))
+        return cursor.rowcount == 1
+
+    def release_turn(self, user_id, owner, answered_up_to):
+        self.execute("UPDATE turns SET lock_owner = NULL, lock_expires_at = NULL, answered_up_to = COALESCE(?, answered_up_to) "
+                     "WHERE user_id = ? AND lock_owner = ?", (answered_up_to, str(user_id), owner))
+
+    def take_token(self, key, capacity, refill_per_second):
+        now = time.time()
+        with self.transaction():
+            row = self.execute("SELECT tokens, updated_at FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row["tokens"] + (now - row["updated_at"]) * refill_per_second)
+            if tokens < 1:
+                return (1 - tokens) / refill_per_second
+            self.execute("INSERT OR REPLACE INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)", (key, tokens - 1, now))
+        return 0
+
+    # Response cache
+    def get_cached_response(self, key):
+        row = self.execute("SELECT item FROM response_cache WHERE key = ? AND expires_at >= ?", (key, time.time())).fetchone()
+        return json.loads(row["item"]) if row else None
+
+    def put_cached_response(self, key, item, ttl):
+        now = time.time()
+        with self.transaction():
+            self.execute("INSERT OR REPLACE INTO response_cache (key, item, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps(item), now + ttl))
+            self.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+            # Past the size bound the entries closest to expiry go first
+            self.execute("DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY expires_at DESC "
+                         "LIMIT -1 OFFSET ?)", (RESPONSE_CACHE_MAX_ITEMS,))
+
+    # Spendings
+    def put_spending(self, item):
+        timestamp = item["timestamp"]
+        for _ in range(SPENDING_WRITE_ATTEMPTS):
+            try:
+                self.execute("INSERT INTO spendings (user_id, timestamp, price_in_10th_of_cents, item) VALUES (?, ?, ?, ?)",
+                             (item["user_id"], timestamp, item["price_in_10th_of_cents"], json.dumps(dict(item, timestamp=timestamp))))
+                return timestamp
+            except sqlite3.IntegrityError:
+                latest = self.execute("SELECT MAX(timestamp) AS timestamp FROM spendings WHERE user_id = ?",
+                                      (item["user_id"],)).fetchone()["timestamp"]
+                timestamp = next_spending_timestamp(latest)
+        raise Exception("No free spending timestamp for user " + item["user_id"])
+
+    def add_to_spending_totals(self, user_id, price, month_bucket):
+        with self.transaction():
+            for bucket in (SPENDING_ALL_TIME_BUCKET, month_bucket):
+                self.execute("INSERT INTO spending_totals (user_id, bucket, price_in_10th_of_cents) VALUES (?, ?, ?) "
+                             "ON CONFLICT (user_id, bucket) DO UPDATE SET price_in_10th_of_cents = price_in_10th_of_cents + excluded.price_in_10th_of_cents",
+                             (str(user_id), bucket, price))
+
+    def get_spending_totals(self, user_id):
+        rows = self.execute("SELECT bucket, price_in_10th_of_cents FROM spending_totals WHERE user_id = ?", (str(user_id),))
+        return {row["bucket"]: row["price_in_10th_of_cents"] for row in rows}
+
+    def get_all_spending_totals(self):
+        rows = self.execute("SELECT user_id, price_in_10th_of_cents FROM spending_totals WHERE bucket = ?",
+                            (SPENDING_ALL_TIME_BUCKET,))
+        return {row["user_id"]: row["price_in_10th_of_cents"] for row in rows}
+
+    def rebuild_spending_totals(self):
+        with self.transaction():
+            totals = {}
+            for row in self.execute("SELECT user_id, timestamp, price_in_10th_of_cents FROM spendings"):
+                for bucket in (SPENDING_ALL_TIME_BUCKET, get_month_bucket(row["timestamp"])):
+                    key = (row["user_id"], bucket)
+                    totals[key] = totals.get(key, 0) + row["price_in_10th_of_cents"]
+            self.execute("DELETE FROM spending_totals")
+            self.connection().executemany("INSERT INTO spending_totals (user_id, bucket, price_in_10th_of_cents) VALUES (?, ?, ?)",
+                                          [(user_id, bucket, price) for (user_id, bucket), price in totals.items()])
+        return self.get_all_spending_totals()
+
+    def put_exchange(self, user_id, messages, spending):
+        # add_to_spending_totals opens its own transaction, the totals are updated inline instead
+        with self.transaction():
+            for message in messages:
+                self.put_message(user_id, message["message_id"], message["role"], message["text"],
+                                 message["tokens_used"], message["tokens"], message.get("expires_at"))
+            timestamp = self.put_spending(spending)
+            for bucket in (SPENDING_ALL_TIME_BUCKET, get_month_bucket(timestamp)):
+                self.execute("INSERT INTO spending_totals (user_id, bucket, price_in_10th_of_cents) VALUES (?, ?, ?) "
+                             "ON CONFLICT (user_id, bucket) DO UPDATE SET price_in_10th_of_cents = price_in_10th_of_cents + excluded.price_in_10th_of_cents",
+                             (str(user_id), bucket, spending["price_in_10th_of_cents"]))
+
+    def transaction(self):
+        return Transaction(self.connection())
+
+
+class Transaction:
+    """BEGIN IMMEDIATE ... COMMIT on the connection, rolled back on errors."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def message_from_row(row):
+    message = dict(row)
+    if "tokens_used" in message:
+        message["tokens_used"] = json.loads(message["tokens_used"])
+    return message
@@ -0,0 +1,59 @@
+"""Local token counts of chat messages, so prompt sizes and costs are known before calling OpenAI.
+
+Uses tiktoken when its encoding can be loaded, from the copy deploy.sh bundles in TIKTOKEN_BUNDLE_DIR or
+from TIKTOKEN_CACHE_DIR. Otherwise the counts are estimated on the high side, at 2 bytes of UTF-8 per token:
+an estimate under the real count would let prompts past the model window through.
+"""
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Encoding of gpt-3.5-turbo and gpt-4
+TIKTOKEN_ENCODING = "cl100k_base"
+TIKTOKEN_BUNDLE_DIR = os.path.join(os.path.dirname(__file__), "tiktoken_cache")
+# English averages about 4 bytes per token, Cyrillic 2 bytes per character and a bit over a character per token
+ESTIMATED_BYTES_PER_TOKEN = 2
+# Chat format tokens around every message, role included, and priming the reply, as counted by OpenAI
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+encoding = None
+encoding_loaded = False
+encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    global encoding, encoding_loaded
+    with encoding_lock:
+        if not encoding_loaded:
+            if os.path.isdir(TIKTOKEN_BUNDLE_DIR):
+                os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_BUNDLE_DIR)
+            try:
+                import tiktoken
+                encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+            except Exception as e:
+                logger.warning("tiktoken is not available, token counts are estimated: " + str(e))
+            encoding_loaded = True
+        return encoding
+
+
+def count_text_tokens(text):
+    current_encoding = get_encoding()
+    if current_encoding is None:
+        return math.ceil(len(text.encode()) / ESTIMATED_BYTES_PER_TOKEN)
+    return len(current_encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(text, tokens=None):
+    """Tokens of a chat message with that text, tokens being the cached count of the text when known."""
+    if tokens is None:
+        tokens = count_text_tokens(text)
+    return int(tokens) + MESSAGE_OVERHEAD_TOKENS
+
+
+def count_prompt_tokens(messages):
+    """Tokens of a prompt made of {"role", "content"} messages."""
+    return sum(count_message_tokens(message["content"]) for message in messages) + REPLY_PRIMING_TOKENS
@@ -0,0 +1,95 @@
+"""Queues between the webhook, which only acknowledges Telegram updates, and the worker processing them."""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# inline: the webhook processes the update itself, lambda: it invokes the worker Lambda asynchronously,
+# local: an in-process queue, only for long-running processes (self-hosting, benchmarks)
+UPDATE_QUEUE = os.getenv("UPDATE_QUEUE", "inline")
+UPDATE_WORKER_FUNCTION = os.getenv("UPDATE_WORKER_FUNCTION")
+LOCAL_QUEUE_WORKERS = int(os.getenv("LOCAL_QUEUE_WORKERS", "8"))
+
+lambda_client = None
+lambda_client_lock = threading.Lock()
+
+
+def get_lambda_client():
+    global lambda_client
+    with lambda_client_lock:
+        if lambda_client is None:
+            import boto3
+            lambda_client = boto3.client("lambda")
+        return lambda_client
+
+
+def get_worker_function_name(handler_name, worker_name):
+    """Chalice names the functions <app>-<stage>-<name>, the worker is deployed next to the webhook handler."""
+    if UPDATE_WORKER_FUNCTION:
+        return UPDATE_WORKER_FUNCTION
+    function_name = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "")
+    if not function_name.endswith(handler_name):
+        raise Exception("Set UPDATE_WORKER_FUNCTION to the name of the update worker Lambda")
+    return function_name[:-len(handler_name)] + worker_name
+
+
+class LambdaUpdateQueue:
+    """Hands the event to the worker Lambda with an asynchronous (Event) invocation.
+
+    Lambda keeps the event in its own queue and retries failed invocations, the worker dedupes them on update_id.
+    """
+
+    def __init__(self, function_name, executor=None):
+        self.function_name = function_name
+        self.executor = executor
+
+    async def put(self, event):
+        payload = json.dumps({"body": event["body"]}).encode()
+        await asyncio.get_running_loop().run_in_executor(self.executor, lambda: get_lambda_client().invoke(
+            FunctionName=self.function_name, InvocationType="Event", Payload=payload))
+
+
+class LocalUpdateQueue:
+    """asyncio stand-in for the worker Lambda: workers tasks consume the events on the running loop.
+
+    Events still queued when the process exits are lost, so it only fits processes that keep running.
+    """
+
+    def __init__(self, process_event, workers=LOCAL_QUEUE_WORKERS):
+        self.process_event = process_event
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+
+    async def put(self, event):
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            # Workers start from an empty context instead of inheriting the one of the first update
+            self.tasks = [contextvars.Context().run(asyncio.create_task, self.work()) for _ in range(self.workers)]
+        await self.queue.put(event)
+
+    async def work(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                await self.process_event(event)
+            except Exception:
+                logger.exception("Queued update failed")
+            finally:
+                self.queue.task_done()
+
+    async def join(self):
+        """Wait until every queued event is processed."""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.queue = None
+        self.tasks = []
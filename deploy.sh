@@ -87,12 +87,47 @@ for table_name in "$DYNAMODB_TABLE_NAME" "$DYNAMODB_USERS_TABLE_NAME" "$DYNAMODB
   fi
 done
 
+# Processed update ids in the config table expire through the table TTL
+if [ "$(aws dynamodb describe-time-to-live --table-name "$DYNAMODB_CONFIG_TABLE_NAME" | jq -r '.TimeToLiveDescription.TimeToLiveStatus')" == "DISABLED" ]; then
+  echo "Enabling TTL on $DYNAMODB_CONFIG_TABLE_NAME"
+  aws dynamodb update-time-to-live --table-name "$DYNAMODB_CONFIG_TABLE_NAME" \
+    --time-to-live-specification "Enabled=true, AttributeName=expires_at" >/dev/null
+fi
+
+# Messages expire through the table TTL as well when MESSAGE_TTL_DAYS is set
+if [ "$(aws dynamodb describe-time-to-live --table-name "$DYNAMODB_TABLE_NAME" | jq -r '.TimeToLiveDescription.TimeToLiveStatus')" == "DISABLED" ]; then
+  echo "Enabling TTL on $DYNAMODB_TABLE_NAME"
+  aws dynamodb update-time-to-live --table-name "$DYNAMODB_TABLE_NAME" \
+    --time-to-live-specification "Enabled=true, AttributeName=expires_at" >/dev/null
+fi
+
+# Bundle the tiktoken encoding under the name of its cache file, so cold starts don't download it
+TIKTOKEN_ENCODING_URL="https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+TIKTOKEN_CACHE_FILE="chalicelib/tiktoken_cache/$(printf '%s' "$TIKTOKEN_ENCODING_URL" | sha1sum | cut -d ' ' -f 1)"
+if [ ! -f "$TIKTOKEN_CACHE_FILE" ]; then
+  echo "Downloading the tiktoken encoding"
+  mkdir -p chalicelib/tiktoken_cache
+  curl -sf -o "$TIKTOKEN_CACHE_FILE" "$TIKTOKEN_ENCODING_URL"
+fi
+
+# The OpenAI requests of an invocation end LAMBDA_DEADLINE_MARGIN_SECONDS before its timeout. Configs made before
+# lambda_timeout was in the template would leave the handlers at the 60 s default of Chalice
+LAMBDA_TIMEOUT_SECONDS=300
+for function_name in lambda-message-handler lambda-update-worker; do
+  if [ -z "$(jq -r --arg f "$function_name" '.stages.dev.lambda_functions[$f].lambda_timeout // .stages.dev.lambda_timeout // .lambda_timeout // empty' .chalice/config.json)" ]; then
+    echo "Setting lambda_timeout of $function_name to $LAMBDA_TIMEOUT_SECONDS s in .chalice/config.json"
+    jq --arg f "$function_name" --argjson t "$LAMBDA_TIMEOUT_SECONDS" '.stages.dev.lambda_functions[$f].lambda_timeout = $t' \
+      .chalice/config.json > .chalice/config.json.tmp
+    mv .chalice/config.json.tmp .chalice/config.json
+  fi
+done
+
 echo "Deploy the chalice app"
 chalice deploy
 
 APP_NAME=$(jq -r '.app_name' ".chalice/config.json")
 # Get the Lambda function name
-LAMBDA_ARN=$(aws lambda list-functions | jq -r ".Functions[] | select(.FunctionName | startswith(\"${APP_NAME}\")) | .FunctionName")
+LAMBDA_ARN=$(aws lambda list-functions | jq -r ".Functions[] | select(.FunctionName | startswith(\"${APP_NAME}\") and endswith(\"lambda-message-handler\")) | .FunctionName")
 
 if [ -z "$LAMBDA_ARN" ]; then
   echo "Lambda function ARN not found. Exiting."
@@ -139,6 +174,16 @@ else
   echo "AmazonDynamoDBFullAccess policy is already attached to the role."
 fi
 
+# With UPDATE_QUEUE=lambda the webhook handler invokes the update worker asynchronously
+ACCOUNT_ID=$(aws sts get-caller-identity | jq -r '.Account')
+REGION=$(aws configure get region)
+echo "Allowing the webhook handler to invoke the update worker..."
+aws iam put-role-policy --role-name "$role_name" --policy-name invoke-update-worker --policy-document "{
+  \"Version\": \"2012-10-17\",
+  \"Statement\": [{\"Effect\": \"Allow\", \"Action\": \"lambda:InvokeFunction\",
+    \"Resource\": \"arn:aws:lambda:${REGION}:${ACCOUNT_ID}:function:${APP_NAME}-${stage}-lambda-update-worker\"}]
+}"
+
 # Extract the TELEGRAM_API_TOKEN from config.json
 TELEGRAM_API_TOKEN=$(jq -r '.environment_variables.TELEGRAM_API_TOKEN' .chalice/config.json)
 
@@ -0,0 +1,110 @@
+"""Long-running bot process for self-hosting, with the handlers of app.py and without Lambda cold starts.
+
+Updates are fetched by long polling, or received on a webhook served by the process itself, and
+processed concurrently. The updates of one user are processed in order, see PerUserUpdateProcessor.
+The per-container caches of app.py stay warm for the life of the process.
+
+    STORAGE_BACKEND=sqlite python server.py
+    python server.py --mode webhook --port 8443 --webhook-url https://bot.example.com/telegram
+"""
+import argparse
+import asyncio
+import logging
+import os
+from urllib.parse import urlparse
+
+# A single process serves all the users, so it gets larger pools than a Lambda container
+os.environ.setdefault("IO_POOL_SIZE", "32")
+
+import app  # noqa: E402
+from chalicelib import metrics  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import BaseUpdateProcessor  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "256"))
+CONNECTION_POOL_SIZE = int(os.getenv("CONNECTION_POOL_SIZE", "64"))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes up to max_concurrent_updates updates at a time, one at a time for each user.
+
+    Text messages don't wait for the previous update of their user: handle_text stores them and answers
+    them in order under the turn of the user, which also answers a burst of them at once. Every update
+    gets its metrics record, like in run_bot_application.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = {}  # user id -> [lock, updates holding or waiting for it]
+
+    async def do_process_update(self, update, coroutine):
+        record = metrics.start_update(cold_start=False)
+        try:
+            if isinstance(update, Update):
+                record.update_type = app.get_update_type(update)
+                record.properties["update_id"] = update.update_id
+            user = update.effective_user if isinstance(update, Update) else None
+            if user is None or record.update_type == "text":
+                await coroutine
+                return
+            record.properties["user_id"] = str(user.id)
+            entry = self.user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await coroutine
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.user_locks[user.id]
+        finally:
+            metrics.emit(record)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", default="polling", choices=["polling", "webhook"])
+    parser.add_argument("--concurrent-updates", type=int, default=CONCURRENT_UPDATES,
+                        help="updates processed at the same time")
+    parser.add_argument("--listen", default="0.0.0.0", help="webhook mode: address to listen on")
+    parser.add_argument("--port", type=int, default=8443, help="webhook mode: port to listen on")
+    parser.add_argument("--webhook-url", help="webhook mode: public URL Telegram sends the updates to")
+    parser.add_argument("--secret-token", default=os.getenv("WEBHOOK_SECRET_TOKEN"),
+                        help="webhook mode: secret Telegram sends along with every update")
+    return parser.parse_args(argv)
+
+
+async def close_openai_session(bot_application):
+    if app.openai_aiohttp_session is not None:
+        await app.openai_aiohttp_session.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    app.OPENAI_CONNECTION_POOL_SIZE = CONNECTION_POOL_SIZE
+    app.bootstrap()
+    bot_application = app.build_application(HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE),
+                                            PerUserUpdateProcessor(args.concurrent_updates))
+    bot_application.post_shutdown = close_openai_session
+    app.application = bot_application
+    if args.mode == "polling":
+        bot_application.run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        if not args.webhook_url:
+            raise SystemExit("--webhook-url is required in webhook mode")
+        # Needs the webhooks extra of python-telegram-bot
+        bot_application.run_webhook(listen=args.listen, port=args.port, url_path=urlparse(args.webhook_url).path.lstrip("/"),
+                                    webhook_url=args.webhook_url, secret_token=args.secret_token,
+                                    allowed_updates=Update.ALL_TYPES)
+
+
+if __name__ == "__main__":
+    main()
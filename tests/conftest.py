@@ -0,0 +1,68 @@
+"""Memory storage backend, OpenAI and Bot API fakes shared by the tests."""
+import pytest
+
+import app
+from bench.fakes import FakeOpenAI
+from chalicelib import storage as storage_module
+from chalicelib.storage.memory import MemoryStorage
+
+CHAT_ID = 1
+
+
+class FakeMessage:
+    def __init__(self, bot, message_id):
+        self.bot = bot
+        self.message_id = message_id
+
+    async def edit_text(self, text, **kwargs):
+        self.bot.texts.append(text)
+        return self
+
+
+class FakeBot:
+    """Records the texts sent and edited, every message gets the next id of the chat."""
+
+    def __init__(self, message_ids):
+        self.message_ids = message_ids
+        self.texts = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.texts.append(text)
+        return FakeMessage(self, next(self.message_ids))
+
+
+class RecordingOpenAI(FakeOpenAI):
+    """Remembers the user message and the parameters of every chat completion."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prompts = []
+        self.params = []
+
+    async def chat_completion(self, model, messages, stream=False, **params):
+        self.prompts.append(messages[-1]["content"])
+        self.params.append(params)
+        return await super().chat_completion(model, messages, stream, **params)
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    storage = MemoryStorage()
+    monkeypatch.setattr(storage_module, "storage", storage)
+    for cache in (app.users_cache, app.config_cache, app.roster_cache, app.response_cache):
+        cache.clear()
+    monkeypatch.setattr(app, "STREAMING_REPLIES", False)
+    monkeypatch.setattr(app, "RESPONSE_CACHE", False)
+    monkeypatch.setattr(app, "COMPACTION_THRESHOLD_TOKENS", 0)
+    monkeypatch.setattr(app, "USER_MONTHLY_BUDGET_USD", 0)
+    monkeypatch.setattr(app, "USER_REQUESTS_PER_MINUTE", 0)
+    monkeypatch.setattr(app, "MODEL_REQUESTS_PER_MINUTE", {})
+    return storage
+
+
+@pytest.fixture
+def openai_fake():
+    openai_fake = RecordingOpenAI(latency=0.2, completion_tokens=5)
+    openai_fake.install()
+    yield openai_fake
+    openai_fake.uninstall()
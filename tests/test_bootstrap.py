@@ -0,0 +1,11 @@
+"""The admin is seeded once per table set, and again when BOT_ADMIN_USER_ID changes."""
+import app
+
+
+def test_new_admin_is_seeded(storage, monkeypatch):
+    for admin_id in ("1", "2"):
+        monkeypatch.setattr(app, "ADMIN_ID", admin_id)
+        monkeypatch.setattr(app, "bootstrapped", False)
+        app.bootstrap()
+        assert storage.has_user(admin_id, app.ADMIN_USER_KEY)
+        assert storage.get_config(admin_id)["model"] == app.MODELS["gpt3"]["model"]
@@ -0,0 +1,26 @@
+"""The monthly budget check counts REPLY_RESERVED_TOKENS as the longest answer, which the completions are capped at."""
+import asyncio
+import itertools
+
+import pytest
+
+import app
+from tests.conftest import FakeBot
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_completions_are_capped_at_the_reserved_tokens(storage, openai_fake, monkeypatch, streaming):
+    monkeypatch.setattr(app, "STREAMING_REPLIES", streaming)
+    monkeypatch.setattr(app, "USER_MONTHLY_BUDGET_USD", 10)
+    app.create_initial_config("42", app.MODELS["gpt3"])
+    asyncio.run(app.process_text(FakeBot(itertools.count(1000)), 1, "hello", "42", 100))
+    assert openai_fake.params[0]["max_tokens"] == app.REPLY_RESERVED_TOKENS
+
+
+def test_request_over_budget_is_refused(storage, openai_fake, monkeypatch):
+    monkeypatch.setattr(app, "USER_MONTHLY_BUDGET_USD", 0.001)
+    app.create_initial_config("42", app.MODELS["gpt4"])
+    bot = FakeBot(itertools.count(1000))
+    assert asyncio.run(app.process_text(bot, 1, "hello", "42", 100)) == (None, None)
+    assert openai_fake.prompts == []
+    assert bot.texts[-1].startswith("This request could cost up to")
@@ -0,0 +1,29 @@
+"""History compaction rolls the previous summary over and deletes only the messages it summarized."""
+import asyncio
+
+import app
+
+SUMMARY_ID = 2
+TURN_TOKENS = 300
+
+
+def test_previous_summary_rolls_over_and_the_rest_is_kept(storage, openai_fake):
+    storage.put_config("42", {"model": "gpt-3.5-turbo", "request_price": 2, "response_price": 2})
+    storage.put_message("42", SUMMARY_ID, "system", app.SUMMARY_PREFIX + "old facts", {}, 10)
+    for message_id in range(3, 40):
+        storage.put_message("42", message_id, "user" if message_id % 2 else "assistant", "turn " + str(message_id),
+                            {}, TURN_TOKENS)
+
+    asyncio.run(app.compact_history("42", 40))
+    transcript = openai_fake.prompts[0]
+    assert transcript.startswith("system: " + app.SUMMARY_PREFIX + "old facts\n")
+    summarized = [int(line.split()[-1]) for line in transcript.splitlines()[1:]]
+    assert summarized == list(range(29, 37))
+    # The new summary takes the place of the newest summarized message, the older history it doesn't cover stays
+    remaining = {int(msg["message_id"]): msg for msg in storage.query_messages("42")}
+    assert sorted(remaining) == list(range(3, 29)) + [36, 37, 38, 39]
+    assert remaining[36]["text"].startswith(app.SUMMARY_PREFIX)
+
+    # Right after a compaction there's nothing new to summarize
+    asyncio.run(app.compact_history("42", 40))
+    assert len(openai_fake.prompts) == 1
@@ -0,0 +1,60 @@
+"""OpenAI requests of a Lambda invocation end by its deadline, with no retry or failover started past it."""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app
+from chalicelib import openai_client
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(openai_client, "breakers", {})
+    monkeypatch.setattr(openai_client, "OPENAI_MIN_ATTEMPT_SECONDS", 0.2)
+
+
+def hanging_call(called):
+    async def call(model_name):
+        called.append(model_name)
+        await asyncio.sleep(60)
+    return call
+
+
+def test_no_retry_nor_failover_past_the_deadline():
+    called = []
+
+    async def scenario():
+        openai_client.set_deadline(0.5)
+        with pytest.raises(asyncio.TimeoutError):
+            await openai_client.call_with_failover(hanging_call(called), "gpt-4", 60, fallback_model="gpt-3.5-turbo")
+
+    started_at = time.monotonic()
+    asyncio.run(scenario())
+    # The only attempt is cut short at the deadline instead of running for its 60 s timeout
+    assert time.monotonic() - started_at < 1
+    assert called == ["gpt-4"]
+
+
+def test_no_attempt_without_time_left():
+    called = []
+
+    async def scenario():
+        openai_client.set_deadline(0.1)
+        with pytest.raises(openai_client.DeadlineExceededError):
+            await openai_client.call_with_retries(lambda: hanging_call(called)("gpt-4"), "gpt-4", 60)
+
+    asyncio.run(scenario())
+    assert called == []
+
+
+def test_invocation_deadline_keeps_the_margin(monkeypatch):
+    monkeypatch.setattr(app, "LAMBDA_DEADLINE_MARGIN_SECONDS", 10)
+    context = SimpleNamespace(get_remaining_time_in_millis=lambda: 300000)
+
+    async def get_time_left():
+        return openai_client.get_time_left()
+
+    assert 289 < app.run_until_deadline(get_time_left(), context) <= 290
+    assert openai_client.get_time_left() is None
@@ -0,0 +1,12 @@
+"""Cold start budget: importing app stays within DEFAULT_BUDGET_MS and leaves the heavy dependencies for first use."""
+from bench.import_time import DEFAULT_BUDGET_MS, LAZY_MODULES, measure_imports
+
+
+def test_import_time_within_budget():
+    imports = measure_imports()
+    assert imports["app"] / 1000 <= DEFAULT_BUDGET_MS
+
+
+def test_heavy_dependencies_are_imported_lazily():
+    imports = measure_imports()
+    assert sorted(name for name in imports if name.split(".")[0] in LAZY_MODULES) == []
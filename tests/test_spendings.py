@@ -0,0 +1,31 @@
+"""Spending rows of the same moment are all kept, so rebuilding the totals from them gives the same totals."""
+import pytest
+
+from chalicelib.storage import SPENDING_ALL_TIME_BUCKET
+from chalicelib.storage.memory import MemoryStorage
+from chalicelib.storage.sqlite import SQLiteStorage
+
+TIMESTAMP = 1760000000.0
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteStorage(str(tmp_path / "bot.sqlite3"))
+    return MemoryStorage()
+
+
+def spending(price):
+    return {"user_id": "42", "timestamp": TIMESTAMP, "price_in_10th_of_cents": price, "model_name": "gpt-3.5-turbo"}
+
+
+def message(message_id):
+    return {"message_id": message_id, "role": "assistant", "text": "answer", "tokens_used": {}, "tokens": 1}
+
+
+def test_spendings_of_the_same_moment_are_kept(storage):
+    for message_id in range(18):
+        storage.put_exchange("42", [message(100 + message_id)], spending(1))
+    assert storage.get_spending_totals("42")[SPENDING_ALL_TIME_BUCKET] == 18
+    assert storage.rebuild_spending_totals() == {"42": 18}
+    assert storage.get_spending_totals("42")[SPENDING_ALL_TIME_BUCKET] == 18
@@ -0,0 +1,117 @@
+"""Turn handoff, burst coalescing and token buckets of handle_text, on the memory storage backend."""
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import app
+from tests.conftest import CHAT_ID, FakeBot
+
+
+def add_user(user_id):
+    app._add_allowed_user(user_id, app.TYPE_ITEM_USER)
+    app.create_initial_config(user_id, app.MODELS["gpt3"])
+
+
+def text_update(update_id, user_id, message_id, text, bot):
+    message = SimpleNamespace(text=text, from_user=SimpleNamespace(id=user_id), id=message_id, chat_id=CHAT_ID,
+                              reply_text=lambda reply: bot.send_message(CHAT_ID, reply))
+    return SimpleNamespace(update_id=update_id, message=message), SimpleNamespace(bot=bot)
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_message_arriving_during_turn_is_answered_once(storage, openai_fake):
+    add_user("42")
+    bot = FakeBot(itertools.count(1000))
+
+    async def scenario():
+        first = asyncio.ensure_future(app.handle_text(*text_update(1, 42, 100, "first", bot)))
+        # The first message holds the turn while OpenAI answers it
+        await asyncio.sleep(0.1)
+        await app.handle_text(*text_update(2, 42, 101, "second", bot))
+        await app.handle_text(*text_update(3, 42, 102, "third", bot))
+        assert openai_fake.prompts == ["first"]
+        await first
+
+    run(scenario())
+    # The messages sent meanwhile get one answer together, after the first one
+    assert openai_fake.prompts == ["first", "second\n\nthird"]
+    assert storage.turns["42"]["owner"] is None
+    assert storage.turns["42"]["answered_up_to"] == 102
+    replies = [msg for msg in storage.query_messages("42") if msg["role"] == "assistant"]
+    assert len(replies) == 2
+
+
+def test_message_after_turn_is_answered_once(storage, openai_fake):
+    add_user("42")
+    bot = FakeBot(itertools.count(1000))
+
+    async def scenario():
+        await app.handle_text(*text_update(1, 42, 100, "first", bot))
+        await app.handle_text(*text_update(2, 42, 101, "second", bot))
+
+    run(scenario())
+    assert openai_fake.prompts == ["first", "second"]
+
+
+def test_user_over_limit_gets_back_pressure_reply(storage, openai_fake, monkeypatch):
+    monkeypatch.setattr(app, "USER_REQUESTS_PER_MINUTE", 1)
+    monkeypatch.setattr(app, "USER_REQUESTS_BURST", 1)
+    add_user("42")
+    bot = FakeBot(itertools.count(1000))
+
+    async def scenario():
+        await app.handle_text(*text_update(1, 42, 100, "first", bot))
+        await app.handle_text(*text_update(2, 42, 101, "second", bot))
+
+    run(scenario())
+    assert openai_fake.prompts == ["first"]
+    assert bot.texts[-1].startswith("Too many requests, please try again in ")
+
+
+def test_model_limit_is_shared_by_users(storage, openai_fake, monkeypatch):
+    monkeypatch.setattr(app, "MODEL_REQUESTS_PER_MINUTE", {"gpt-3.5-turbo": 6})
+    add_user("42")
+    add_user("43")
+    bot = FakeBot(itertools.count(1000))
+
+    async def scenario():
+        await app.handle_text(*text_update(1, 42, 100, "first", bot))
+        await app.handle_text(*text_update(2, 43, 100, "second", bot))
+
+    run(scenario())
+    assert openai_fake.prompts == ["first"]
+    assert bot.texts[-1] == app.RATE_LIMITED_TEXT.format(10)
+
+
+def test_legacy_model_is_answered_at_the_prices_of_the_user(storage, openai_fake):
+    app._add_allowed_user("42", app.TYPE_ITEM_USER)
+    storage.put_config("42", {"model": "gpt-3.5-turbo-0301", "request_price": 1000, "response_price": 1000})
+    bot = FakeBot(itertools.count(1000))
+
+    run(app.handle_text(*text_update(1, 42, 100, "first", bot)))
+    assert openai_fake.prompts == ["first"]
+    spending = next(iter(storage.spendings.values()))
+    expected = (spending["prompt_tokens"] + spending["completion_tokens"]) * 1000 / 1000 / 1000
+    assert bot.texts[-1].endswith("It costed " + str(expected) + " USD")
+
+
+def test_long_answer_keeps_the_turn(storage, openai_fake, monkeypatch):
+    monkeypatch.setattr(app, "TURN_TTL_SECONDS", 0.3)
+    monkeypatch.setattr(app, "TURN_RENEW_SECONDS", 0.1)
+    openai_fake.latency = 1
+    add_user("42")
+    bot = FakeBot(itertools.count(1000))
+
+    async def scenario():
+        first = asyncio.ensure_future(app.handle_text(*text_update(1, 42, 100, "first", bot)))
+        # Well past the TTL of the turn, which the answering invocation keeps renewing
+        await asyncio.sleep(0.7)
+        assert storage.acquire_turn("42", "other", app.TURN_TTL_SECONDS) == (False, None)
+        await first
+
+    run(scenario())
+    assert openai_fake.prompts == ["first"]
+    assert storage.acquire_turn("42", "other", app.TURN_TTL_SECONDS) == (True, 100)